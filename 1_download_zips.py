@@ -14,8 +14,14 @@ Usage:
 
 import boto3
 import os
+import math
 import yaml
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
 from pathlib import Path
+from boto3.s3.transfer import S3Transfer, TransferConfig
+from botocore.config import Config
 from botocore.exceptions import NoCredentialsError, ClientError
 from dotenv import load_dotenv
 from tqdm import tqdm
@@ -31,6 +37,10 @@ args = parser.parse_args()
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Silence per-request chatter from the AWS SDK when many downloads run concurrently
+for noisy_logger in ('boto3', 'botocore', 'urllib3'):
+    logging.getLogger(noisy_logger).setLevel(logging.WARNING)
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -50,6 +60,16 @@ def load_config():
                 dataset_info['end_date'] = today
                 print(f"Updated {dataset_key} end_date to: {today}")
     
+    # Fill in S3 transfer defaults for configs without an s3 section
+    s3_settings = config.get('s3') or {}
+    config['s3'] = s3_settings
+    s3_settings.setdefault('download_workers', 16)
+    s3_settings.setdefault('max_pool_connections', 32)
+    s3_settings.setdefault('s3_max_concurrency', 10)
+    s3_settings.setdefault('s3_multipart_chunksize', 8 * 1024 * 1024)
+    s3_settings.setdefault('adaptive_concurrency', True)
+    s3_settings.setdefault('max_download_workers', 64)
+    
     return config
 
 # Load configuration
@@ -75,6 +95,28 @@ def get_datasets_from_config(config):
 
 DATASETS = get_datasets_from_config(config)
 
+# Download concurrency - the workload is network-bound, so threads are sufficient
+S3_SETTINGS = config['s3']
+DOWNLOAD_WORKERS = S3_SETTINGS['download_workers']
+MAX_POOL_CONNECTIONS = S3_SETTINGS['max_pool_connections']
+ADAPTIVE_CONCURRENCY = S3_SETTINGS['adaptive_concurrency']
+MAX_DOWNLOAD_WORKERS = S3_SETTINGS['max_download_workers']
+
+# S3 error codes signalling that requests should back off
+THROTTLE_ERROR_CODES = {'SlowDown', 'RequestLimitExceeded', 'Throttling', 'ThrottlingException', '503'}
+
+# Large objects are fetched as parallel byte-range GETs
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=S3_SETTINGS['s3_multipart_chunksize'],
+    multipart_chunksize=S3_SETTINGS['s3_multipart_chunksize'],
+    max_concurrency=S3_SETTINGS['s3_max_concurrency'],
+    use_threads=True
+)
+
+_S3 = None
+_TRANSFER = None
+_TRANSFER_LOCK = threading.Lock()
+
 # Get credentials from environment variables
 aws_access_key_id = os.getenv('AWS_ACCESS_KEY_ID')
 aws_secret_access_key = os.getenv('AWS_SECRET_ACCESS_KEY')
@@ -82,13 +124,92 @@ aws_secret_access_key = os.getenv('AWS_SECRET_ACCESS_KEY')
 if not aws_access_key_id or not aws_secret_access_key:
     raise ValueError("AWS credentials not found in .env file. Please ensure AWS_ACCESS_KEY_ID and AWS_SECRET_ACCESS_KEY are set.")
 
-def verify_aws_credentials():
+class AdaptiveConcurrencyController:
+    """AIMD controller for the number of concurrent downloads.
+
+    A background thread samples aggregate throughput every ``interval`` seconds.
+    Concurrency grows by one while throughput keeps rising by at least 5% and is
+    halved when a window stalls or S3 reports throttling, bounded to
+    ``[min_concurrency, max_concurrency]``.
+    """
+
+    def __init__(self, initial, min_concurrency=1, max_concurrency=64, interval=2.0):
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.limit = max(min_concurrency, min(initial, max_concurrency))
+        self.interval = interval
+        self._active = 0
+        self._bytes = 0
+        self._throttled = False
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def acquire(self):
+        with self._cond:
+            while self._active >= self.limit:
+                self._cond.wait()
+            self._active += 1
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    def record_bytes(self, bytes_amount):
+        with self._cond:
+            self._bytes += bytes_amount
+
+    def record_error(self, error):
+        if isinstance(error, ClientError):
+            code = error.response.get('Error', {}).get('Code')
+            if code in THROTTLE_ERROR_CODES:
+                with self._cond:
+                    self._throttled = True
+
+    def _run(self):
+        last_throughput = None
+        while not self._stop.wait(self.interval):
+            with self._cond:
+                throughput = self._bytes / self.interval
+                self._bytes = 0
+                stalled = self._active > 0 and throughput == 0
+                if self._throttled or stalled:
+                    self.limit = max(self.min_concurrency, self.limit // 2)
+                elif last_throughput is not None and throughput >= last_throughput * 1.05:
+                    self.limit = min(self.max_concurrency, self.limit + 1)
+                self._throttled = False
+                self._cond.notify_all()
+            last_throughput = throughput
+            logger.debug(f"Download concurrency: {self.limit} ({format_size(throughput)}/s)")
+
+def get_s3_client():
+    """Return the shared S3 client, creating it on first use.
+
+    boto3 clients are thread-safe, so one client (and its connection pool) is
+    reused across datasets and download threads.
+    """
+    global _S3
+    if _S3 is None:
+        _S3 = boto3.client('s3',
+                           aws_access_key_id=aws_access_key_id,
+                           aws_secret_access_key=aws_secret_access_key,
+                           config=Config(max_pool_connections=MAX_POOL_CONNECTIONS,
+                                         retries={'mode': 'adaptive', 'max_attempts': 5}))
+    return _S3
+
+def verify_aws_credentials(s3):
     """Verify AWS credentials by attempting to list buckets."""
     try:
         print("Verifying AWS credentials...")
-        s3 = boto3.client('s3',
-                         aws_access_key_id=aws_access_key_id,
-                         aws_secret_access_key=aws_secret_access_key)
         s3.list_buckets()
         print("AWS credentials verified successfully!")
         return True
@@ -101,98 +222,192 @@ def format_size(size_bytes):
     if size_bytes == 0:
         return "0B"
     size_names = ["B", "KB", "MB", "GB", "TB"]
-    i = 0
-    while size_bytes >= 1024 and i < len(size_names) - 1:
-        size_bytes /= 1024.0
-        i += 1
-    return f"{size_bytes:.1f}{size_names[i]}"
-
-def list_available_files(s3_client, bucket, folder, dataset):
-    """List available files in S3 bucket for a specific dataset."""
-    try:
+    i = min(int(math.log(max(size_bytes, 1), 1024)), len(size_names) - 1)
+    return f"{size_bytes / 1024 ** i:.1f}{size_names[i]}"
+
+def get_date_prefixes(folder, start_date, end_date):
+    """Build one S3 key prefix per calendar year spanned by the date window."""
+    folder = folder.rstrip('/')
+    return [f"{folder}/{year}" for year in range(start_date.year, end_date.year + 1)]
+
+def get_start_after_key(folder, local_path, latest_date):
+    """Build the S3 key of the latest local zip, for use as ``StartAfter``.
+
+    Keys are laid out as ``<folder>/<name>_YYYY-MM-DD.zip``, so the local file
+    for ``latest_date`` gives the exact key to resume listing after. Returns
+    None when no local zip carries that date.
+    """
+    local_path = Path(local_path)
+    if not local_path.exists():
+        return None
+    for zip_file in local_path.glob(f'*{latest_date}*.zip'):
+        return f"{folder.rstrip('/')}/{zip_file.name}"
+    return None
+
+def list_available_files(s3_client, bucket, folder, dataset, start_date=None, end_date=None, latest_date=None):
+    """List available files in S3 bucket for a specific dataset.
+
+    When a date window is given, listing is narrowed to year prefixes so S3 only
+    returns keys inside the window. If the bucket layout is not date-prefixed
+    (nothing found), the full folder is listed instead. When ``latest_date`` is
+    given, S3 starts listing after the key of the local zip for that date, so
+    the folder listing only returns newer files; the date window is still
+    applied to every returned key.
+    """
+    page_kwargs = {}
+    if latest_date:
+        start_after = get_start_after_key(folder, dataset['local_path'], latest_date)
+        if start_after:
+            page_kwargs['StartAfter'] = start_after
+        else:
+            logger.info(f"No local zip for {latest_date} - listing without StartAfter")
+    
+    def scan(prefixes):
         paginator = s3_client.get_paginator('list_objects_v2')
-        page_iterator = paginator.paginate(Bucket=bucket, Prefix=folder)
-        
         files = []
-        for page in page_iterator:
-            if 'Contents' in page:
-                for obj in page['Contents']:
-                    if obj['Key'].endswith('.zip'):
-                        filename = obj['Key'].split('/')[-1]
-                        date_match = re.search(r'(\d{4}-\d{2}-\d{2})', filename)
-                        if date_match:
-                            file_date = datetime.strptime(date_match.group(1), '%Y-%m-%d').date()
-                            files.append({
-                                'key': obj['Key'],
-                                'size': obj['Size'],
-                                'date': file_date,
-                                'filename': filename
-                            })
+        for prefix in prefixes:
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix, **page_kwargs):
+                if 'Contents' in page:
+                    for obj in page['Contents']:
+                        if obj['Key'].endswith('.zip'):
+                            filename = obj['Key'].split('/')[-1]
+                            date_match = re.search(r'(\d{4}-\d{2}-\d{2})', filename)
+                            if date_match:
+                                file_date = datetime.strptime(date_match.group(1), '%Y-%m-%d').date()
+                                if start_date and file_date < start_date:
+                                    continue
+                                if end_date and file_date > end_date:
+                                    continue
+                                files.append({
+                                    'key': obj['Key'],
+                                    'size': obj['Size'],
+                                    'date': file_date,
+                                    'filename': filename
+                                })
         return files
+
+    try:
+        if start_date and end_date:
+            files = scan(get_date_prefixes(folder, start_date, end_date))
+            if files:
+                return files
+            logger.info(f"No date-prefixed keys under {folder} - listing full folder")
+        return scan([folder])
     except ClientError as e:
         logger.error(f"Error listing files in bucket {bucket}: {e}")
         return []
 
-def download_file(s3_client, bucket, file_info, dataset):
-    """Download a single file from S3."""
+def get_transfer(s3_client):
+    """Return the shared S3Transfer manager, creating it on first use."""
+    global _TRANSFER
+    with _TRANSFER_LOCK:
+        if _TRANSFER is None:
+            _TRANSFER = S3Transfer(s3_client, TRANSFER_CONFIG)
+    return _TRANSFER
+
+def download_file(s3_client, bucket, file_info, dataset, progress=None, on_error=None):
+    """Download a single file from S3.
+
+    ``progress`` is an optional callable receiving the number of bytes
+    transferred since its previous invocation; ``on_error`` is called with any
+    exception raised by the transfer.
+    """
     local_path = Path(dataset['local_path'])
     local_path.mkdir(parents=True, exist_ok=True)
     
     local_file = local_path / file_info['filename']
     
-    if local_file.exists():
+    if local_file.exists() and local_file.stat().st_size == file_info['size']:
         logger.info(f"File already exists: {local_file}")
         return True
     
     try:
-        logger.info(f"Downloading {file_info['filename']} ({format_size(file_info['size'])})")
+        logger.debug(f"Downloading {file_info['filename']} ({format_size(file_info['size'])})")
         
-        with tqdm(total=file_info['size'], unit='B', unit_scale=True, desc=file_info['filename']) as pbar:
-            def callback(bytes_transferred):
-                pbar.update(bytes_transferred - pbar.n)
-            
-            s3_client.download_file(
-                bucket, 
-                file_info['key'], 
-                str(local_file),
-                Callback=callback
-            )
+        get_transfer(s3_client).download_file(
+            bucket, 
+            file_info['key'], 
+            str(local_file),
+            callback=progress
+        )
         
-        logger.info(f"Successfully downloaded {file_info['filename']}")
+        logger.debug(f"Successfully downloaded {file_info['filename']}")
         return True
     except Exception as e:
         logger.error(f"Error downloading {file_info['filename']}: {e}")
+        if on_error is not None:
+            on_error(e)
         return False
 
-def process_dataset(config, dataset_key, dataset_info):
-    """Process a single dataset."""
+def process_dataset(config, dataset_key, dataset_info, s3):
+    """Process a single dataset using a shared S3 client."""
     logger.info(f"Processing dataset: {dataset_info['name']}")
     
-    s3 = boto3.client('s3',
-                      aws_access_key_id=aws_access_key_id,
-                      aws_secret_access_key=aws_secret_access_key)
+    # Date range (if specified) is applied while listing
+    start_date = end_date = None
+    if dataset_info.get('start_date') and dataset_info.get('end_date'):
+        start_date = datetime.strptime(dataset_info['start_date'], '%Y-%m-%d').date()
+        end_date = datetime.strptime(dataset_info['end_date'], '%Y-%m-%d').date()
+        logger.info(f"Listing files in date range {start_date} to {end_date}")
     
-    files = list_available_files(s3, dataset_info['bucket'], dataset_info['path'], dataset_info)
+    files = list_available_files(s3, dataset_info['bucket'], dataset_info['path'], dataset_info,
+                                 start_date=start_date, end_date=end_date,
+                                 latest_date=args.latest_date)
     
     if not files:
         logger.warning(f"No files found for dataset {dataset_key}")
         return
     
-    # Filter files based on date range if specified
-    if dataset_info.get('start_date') and dataset_info.get('end_date'):
-        start_date = datetime.strptime(dataset_info['start_date'], '%Y-%m-%d').date()
-        end_date = datetime.strptime(dataset_info['end_date'], '%Y-%m-%d').date()
-        files = [f for f in files if start_date <= f['date'] <= end_date]
-        logger.info(f"Filtered to {len(files)} files in date range {start_date} to {end_date}")
+    # Skip files already present locally with the expected size (one directory scan)
+    local_path = Path(dataset_info['local_path'])
+    local_path.mkdir(parents=True, exist_ok=True)
+    with os.scandir(local_path) as entries:
+        existing = {entry.name: entry.stat().st_size for entry in entries if entry.is_file()}
+    
+    total_files = len(files)
+    files = [f for f in files if existing.get(f['filename']) != f['size']]
+    if total_files > len(files):
+        logger.info(f"Skipping {total_files - len(files)} files already downloaded")
+    
+    if not files:
+        logger.info("All files already downloaded")
+        return
     
     successful_downloads = 0
     total_size = sum(f['size'] for f in files)
     
     logger.info(f"Found {len(files)} files to download (total size: {format_size(total_size)})")
     
-    for file_info in files:
-        if download_file(s3, dataset_info['bucket'], file_info, dataset_info):
-            successful_downloads += 1
+    if ADAPTIVE_CONCURRENCY:
+        controller = AdaptiveConcurrencyController(DOWNLOAD_WORKERS, max_concurrency=MAX_DOWNLOAD_WORKERS)
+        max_workers = MAX_DOWNLOAD_WORKERS
+    else:
+        controller = None
+        max_workers = DOWNLOAD_WORKERS
+    
+    # Single aggregate progress bar shared by all worker threads
+    pbar_lock = threading.Lock()
+    with tqdm(total=total_size, unit='B', unit_scale=True, desc=dataset_key, position=0) as pbar:
+        def progress(bytes_amount):
+            with pbar_lock:
+                pbar.update(bytes_amount)
+            if controller is not None:
+                controller.record_bytes(bytes_amount)
+        
+        def download(file_info):
+            if controller is None:
+                return download_file(s3, dataset_info['bucket'], file_info, dataset_info, progress)
+            controller.acquire()
+            try:
+                return download_file(s3, dataset_info['bucket'], file_info, dataset_info, progress,
+                                     on_error=controller.record_error)
+            finally:
+                controller.release()
+        
+        with controller or nullcontext(), ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(download, file_info) for file_info in files]
+            for future in as_completed(futures):
+                successful_downloads += bool(future.result())
     
     logger.info(f"Successfully downloaded {successful_downloads}/{len(files)} files")
 
@@ -200,13 +415,15 @@ def main():
     """Main function."""
     print("=== SpiderRock AWS Data Download Script ===")
     
-    if not verify_aws_credentials():
+    s3 = get_s3_client()
+    
+    if not verify_aws_credentials(s3):
         print("Failed to verify AWS credentials. Please check your .env file.")
         return
     
     for dataset_key, dataset_info in DATASETS.items():
         try:
-            process_dataset(config, dataset_key, dataset_info)
+            process_dataset(config, dataset_key, dataset_info, s3)
         except Exception as e:
             logger.error(f"Error processing dataset {dataset_key}: {e}")
     
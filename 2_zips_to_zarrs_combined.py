@@ -9,6 +9,7 @@ Key features:
 - Processes files in small batches to manage memory
 - Uses flat dataset structure during processing
 - Properly handles existing zarr structure where teo, ticker, years are data variables
+- Parses with PyArrow and combines batches as Arrow tables
 - Uses efficient memory management and garbage collection
 - Handles large datasets without memory issues
 - Only processes new ZIP files that contain dates not already in the zarr store
@@ -19,17 +20,22 @@ import pandas as pd
 import numpy as np
 import xarray as xr
 import zarr
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
 from zipfile import ZipFile
 from pathlib import Path
 import logging
 from tqdm import tqdm
 import gc
 import time
+from concurrent.futures import ProcessPoolExecutor
 import re
 from datetime import datetime
-from numcodecs import Blosc
 import warnings
+import json
 import yaml
+from zarr_writer import write_columns_to_zarr
 warnings.filterwarnings("ignore", message=".*vlen-utf8.*")
 
 def load_config():
@@ -49,6 +55,41 @@ OUTPUT_ZARR = os.path.join(OUTPUT_DIR, "surface_curve_history_combined_data_vars
 # Data columns to keep (matching config.yaml)
 KEEP_COLUMNS = ["ticker_tk", "tradingDate", "rate", "years", "atmVol", "atmCen", "atmVega", "slope", "cCnt", "pCnt", "vwidth"]
 
+# Column types applied while parsing (tickers are dictionary-encoded as int32 codes)
+_DTYPES = {
+    'ticker_tk': pa.dictionary(pa.int32(), pa.string()),
+    'tradingDate': pa.timestamp('ns'),
+    'rate': pa.float32(),
+    'years': pa.float32(),
+    'atmVol': pa.float32(),
+    'atmCen': pa.float32(),
+    'atmVega': pa.float32(),
+    'slope': pa.float32(),
+    'cCnt': pa.float32(),  # Counts stay float so empty fields parse as NaN, not a sentinel
+    'pCnt': pa.float32(),
+    'vwidth': pa.float32()
+}
+
+# On-disk dtypes for numeric columns - single precision is sufficient for this data
+NUMERIC_DTYPES = {
+    'rate': 'float32',
+    'years': 'float32',
+    'atmVol': 'float32',
+    'atmCen': 'float32',
+    'atmVega': 'float32',
+    'slope': 'float32',
+    'cCnt': 'float32',  # NaN-capable, still 4 bytes; missing counts are dropped downstream
+    'pCnt': 'float32',
+    'vwidth': 'float32'
+}
+
+# Arrow CSV options - blocks of the decompressed text are parsed on multiple threads
+_READ_OPTIONS = pa_csv.ReadOptions(use_threads=True, block_size=8 << 20)
+_PARSE_OPTIONS = pa_csv.ParseOptions(delimiter='\t', invalid_row_handler=lambda row: 'skip')
+# Columns absent from a file come back as nulls instead of failing the whole day
+_CONVERT_OPTIONS = pa_csv.ConvertOptions(include_columns=KEEP_COLUMNS, column_types=_DTYPES,
+                                         include_missing_columns=True)
+
 # Column mapping for final dataset
 COLUMN_MAPPING = {
     "tradingDate": "teo",
@@ -59,6 +100,7 @@ COLUMN_MAPPING = {
 BATCH_SIZE = 10  # Process this many files before writing to zarr
 CHUNK_SIZE = 5000  # Process this many rows at a time within each file
 MAX_MEMORY_ROWS = 100000  # Maximum rows to keep in memory at once
+MAX_WORKERS = os.cpu_count()  # Worker processes for decompressing and parsing ZIP files
 
 # Set up logging
 logging.basicConfig(
@@ -75,100 +117,100 @@ def extract_date_from_filename(filename):
         return pd.to_datetime(match.group(1))
     return None
 
-def get_column_names(header_line):
-    """Extract column names from header line."""
-    return header_line.strip().split('\t')
-
-def process_values(line):
-    """Process a line of tab-separated values."""
-    return line.strip().split('\t')
-
-def infer_column_types(df, date_columns={'tradingDate'}, string_columns={'ticker_tk'}):
-    """Infer and set proper data types for columns."""
-    for col in date_columns:
-        if col in df.columns:
-            df[col] = pd.to_datetime(df[col], errors='coerce')
-    
-    for col in string_columns:
-        if col in df.columns:
-            df[col] = df[col].astype(str)
-    
-    # Convert numeric columns
-    numeric_cols = ['rate', 'years', 'atmVol', 'atmCen', 'atmVega', 'slope', 'cCnt', 'pCnt', 'vwidth']
-    for col in numeric_cols:
-        if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors='coerce')
-    
-    return df
-
 def process_zip_file(zip_path):
-    """Process a single ZIP file and return DataFrame."""
+    """Process a single ZIP file and return an Arrow table."""
     try:
         with ZipFile(zip_path) as zf:
             txt_files = [f for f in zf.filelist if f.filename.endswith('.txt')]
             if not txt_files:
                 return None
             
-            # Read the first txt file
+            # Stream the first txt file into the multithreaded Arrow reader block by
+            # block, so the decompressed text is never held in memory as a whole
             txt_file = txt_files[0]
             with zf.open(txt_file) as f:
-                lines = f.readlines()
-            
-            if len(lines) < 2:
-                return None
-            
-            # Get column names from header
-            header_line = lines[0].decode('utf-8')
-            columns = get_column_names(header_line)
-            
-            # Process data lines
-            data = []
-            for line in lines[1:]:
-                values = process_values(line.decode('utf-8'))
-                if len(values) == len(columns):
-                    data.append(values)
+                table = pa_csv.read_csv(
+                    f,
+                    read_options=_READ_OPTIONS,
+                    parse_options=_PARSE_OPTIONS,
+                    convert_options=_CONVERT_OPTIONS
+                )
             
-            if not data:
+            if table.num_rows == 0:
                 return None
             
-            # Create DataFrame
-            df = pd.DataFrame(data, columns=columns)
+            missing = [name for name in table.column_names
+                       if table.column(name).null_count == table.num_rows]
+            if missing:
+                logger.warning(f"{zip_path}: columns missing or empty, filled with nulls: {missing}")
             
-            # Keep only specified columns
-            available_columns = [col for col in KEEP_COLUMNS if col in df.columns]
-            df = df[available_columns]
-            
-            # Infer and set data types
-            df = infer_column_types(df)
-            
-            return df
+            return table
             
     except Exception as e:
         logger.error(f"Error processing {zip_path}: {e}")
         return None
 
-def save_flat_dataset_to_zarr(dataframes, output_path):
-    """Save a list of DataFrames to a flat zarr dataset."""
-    if not dataframes:
+def combine_tables(tables):
+    """Concatenate Arrow tables and apply the column mapping (metadata-only rename)."""
+    table = pa.concat_tables(tables, promote_options='default')
+    return table.rename_columns([COLUMN_MAPPING.get(name, name) for name in table.column_names])
+
+def table_to_columns(table, start=0):
+    """Convert Arrow columns to NumPy arrays keyed by name, plus the flat ``index``.
+
+    Dictionary-encoded tickers expand to an object array that only references the
+    few category strings; the store keeps vlen-utf8 tickers so existing stores and
+    downstream readers are unaffected.
+    """
+    columns = {'index': np.arange(start, start + table.num_rows, dtype='int64')}
+    for name in table.column_names:
+        columns[name] = table.column(name).to_numpy()
+    return columns
+
+def get_day_offsets_path(zarr_path):
+    """Path of the JSON sidecar mapping each trading date to its index range."""
+    return os.path.splitext(zarr_path)[0] + '_day_offsets.json'
+
+def load_day_offsets(zarr_path):
+    """Load the trading date -> [start, end) index map stored beside the zarr store."""
+    offsets_path = get_day_offsets_path(zarr_path)
+    if not os.path.exists(offsets_path):
+        return {}
+    with open(offsets_path, 'r') as f:
+        return json.load(f)
+
+def save_day_offsets(zarr_path, offsets):
+    """Write the trading date -> [start, end) index map beside the zarr store."""
+    with open(get_day_offsets_path(zarr_path), 'w') as f:
+        json.dump(offsets, f, sort_keys=True)
+
+def compute_day_offsets(table, start=0):
+    """Map each trading date in a teo-sorted table to its [start, end) index range."""
+    days = pc.cast(table['teo'], pa.date32()).to_numpy().astype('datetime64[D]')
+    unique_days, first_idx, counts = np.unique(days, return_index=True, return_counts=True)
+    return {
+        str(day): [int(start + i), int(start + i + n)]
+        for day, i, n in zip(unique_days, first_idx, counts)
+    }
+
+def save_flat_dataset_to_zarr(tables, output_path):
+    """Save a list of Arrow tables to a flat zarr dataset.
+
+    Rows are written sorted by date so each trading date occupies one contiguous
+    index range; the ranges are recorded in a JSON sidecar so readers can select
+    a date with an ``index`` slice instead of scanning ``teo``.
+    """
+    if not tables:
         return
     
-    # Combine all DataFrames
-    combined_df = pd.concat(dataframes, ignore_index=True)
-    
-    # Rename columns according to mapping
-    for old_name, new_name in COLUMN_MAPPING.items():
-        if old_name in combined_df.columns:
-            combined_df = combined_df.rename(columns={old_name: new_name})
-    
-    # Convert to xarray Dataset
-    ds = combined_df.to_xarray()
+    # Combine all tables, one contiguous block per trading date
+    combined = combine_tables(tables).sort_by('teo')
     
     # Save to zarr with compression
-    ds.to_zarr(output_path, mode='w', consolidated=True, 
-               encoding={var: {'compressor': Blosc(cname='zstd', clevel=3, shuffle=Blosc.SHUFFLE)} 
-                        for var in ds.data_vars})
+    write_columns_to_zarr(table_to_columns(combined), output_path, mode='w', dtypes=NUMERIC_DTYPES)
+    save_day_offsets(output_path, compute_day_offsets(combined))
     
-    logger.info(f"Saved {len(combined_df)} rows to {output_path}")
+    logger.info(f"Saved {combined.num_rows} rows to {output_path}")
 
 def get_existing_zarr_dates(zarr_path):
     """Get dates already present in the zarr store."""
@@ -176,18 +218,16 @@ def get_existing_zarr_dates(zarr_path):
         return set()
     
     try:
-        ds = xr.open_zarr(zarr_path)
+        ds = xr.open_zarr(zarr_path, consolidated=True, chunks={})
+        
+        # Try to get dates from the dataset - only the date variable is read
+        for date_var in ('teo', 'tradingDate'):
+            if date_var in ds.data_vars:
+                days = ds[date_var].load().values.astype('datetime64[D]')
+                return set(np.unique(days).tolist())
         
-        # Try to get dates from the dataset
-        if 'teo' in ds.data_vars:
-            dates = pd.to_datetime(ds['teo'].values)
-            return set(dates.date())
-        elif 'tradingDate' in ds.data_vars:
-            dates = pd.to_datetime(ds['tradingDate'].values)
-            return set(dates.date())
-        else:
-            logger.warning("Could not find date column in existing zarr")
-            return set()
+        logger.warning("Could not find date column in existing zarr")
+        return set()
             
     except Exception as e:
         logger.warning(f"Error reading existing zarr: {e}")
@@ -200,48 +240,55 @@ def get_new_zip_files(existing_zarr_dates):
         logger.error(f"Input directory does not exist: {input_path}")
         return []
     
-    zip_files = list(input_path.glob('*.zip'))
     new_files = []
     
-    for zip_file in zip_files:
+    for zip_file in input_path.glob('*.zip'):
         file_date = extract_date_from_filename(zip_file.name)
         if file_date and file_date.date() not in existing_zarr_dates:
             new_files.append(zip_file)
     
     return sorted(new_files)
 
-def append_to_existing_zarr_fixed(new_dataframes, existing_zarr_path):
-    """Append new data to existing zarr store."""
-    if not new_dataframes:
+def append_to_existing_zarr_fixed(new_tables, existing_zarr_path, existing_dates=None):
+    """Append new data to existing zarr store along the flat ``index`` dimension.
+
+    Only new chunks are written; existing chunks are never read back. Rows whose
+    date is already in the store are dropped before appending.
+    """
+    if not new_tables:
         return
     
-    # Combine new DataFrames
-    new_combined_df = pd.concat(new_dataframes, ignore_index=True)
+    # Combine new tables, one contiguous block per trading date
+    new_combined = combine_tables(new_tables).sort_by('teo')
     
-    # Rename columns according to mapping
-    for old_name, new_name in COLUMN_MAPPING.items():
-        if old_name in new_combined_df.columns:
-            new_combined_df = new_combined_df.rename(columns={old_name: new_name})
+    # Skip rows for dates the store already holds
+    if existing_dates is None:
+        existing_dates = get_existing_zarr_dates(existing_zarr_path)
+    if existing_dates:
+        days = pc.cast(new_combined['teo'], pa.date32())
+        known_days = pa.array(sorted(existing_dates), type=pa.date32())
+        new_combined = new_combined.filter(pc.invert(pc.is_in(days, value_set=known_days)))
     
-    # Load existing data
-    existing_ds = xr.open_zarr(existing_zarr_path)
-    existing_df = existing_ds.to_dataframe().reset_index()
+    # Remove duplicates within the new batch only
+    keys = new_combined.select(['ticker', 'teo', 'years']).to_pandas()
+    new_combined = new_combined.filter(pa.array(~keys.duplicated().to_numpy()))
     
-    # Combine with new data
-    combined_df = pd.concat([existing_df, new_combined_df], ignore_index=True)
+    if new_combined.num_rows == 0:
+        logger.info("No new rows to append to existing zarr")
+        return
     
-    # Remove duplicates if any
-    combined_df = combined_df.drop_duplicates()
+    # Continue the flat index from the end of the existing store
+    existing_len = zarr.open_group(existing_zarr_path, mode='r')['index'].shape[0]
     
-    # Convert back to xarray
-    new_ds = combined_df.to_xarray()
+    # Append new chunks only (encoding is inherited from the existing arrays)
+    write_columns_to_zarr(table_to_columns(new_combined, start=existing_len), existing_zarr_path, mode='a',
+                          dtypes=NUMERIC_DTYPES)
     
-    # Save with compression
-    new_ds.to_zarr(existing_zarr_path, mode='w', consolidated=True,
-                   encoding={var: {'compressor': Blosc(cname='zstd', clevel=3, shuffle=Blosc.SHUFFLE)} 
-                            for var in new_ds.data_vars})
+    offsets = load_day_offsets(existing_zarr_path)
+    offsets.update(compute_day_offsets(new_combined, start=existing_len))
+    save_day_offsets(existing_zarr_path, offsets)
     
-    logger.info(f"Appended {len(new_combined_df)} new rows to existing zarr")
+    logger.info(f"Appended {new_combined.num_rows} new rows to existing zarr")
 
 def main():
     """Main processing function."""
@@ -262,34 +309,34 @@ def main():
         logger.info("No new files to process")
         return
     
-    # Process files in batches
-    all_dataframes = []
+    # Process files in batches, flushing each batch to zarr so memory stays bounded
     batch_count = 0
     
-    for i in tqdm(range(0, len(new_zip_files), BATCH_SIZE), desc="Processing batches"):
-        batch_files = new_zip_files[i:i + BATCH_SIZE]
-        batch_dataframes = []
-        
-        for zip_file in tqdm(batch_files, desc=f"Batch {batch_count + 1}"):
-            df = process_zip_file(zip_file)
-            if df is not None:
-                batch_dataframes.append(df)
-        
-        if batch_dataframes:
-            all_dataframes.extend(batch_dataframes)
-        
-        batch_count += 1
-        
-        # Clear memory
-        gc.collect()
-    
-    # Save or append to zarr
-    if os.path.exists(OUTPUT_ZARR):
-        logger.info("Appending to existing zarr store")
-        append_to_existing_zarr_fixed(all_dataframes, OUTPUT_ZARR)
-    else:
-        logger.info("Creating new zarr store")
-        save_flat_dataset_to_zarr(all_dataframes, OUTPUT_ZARR)
+    # Parsing is CPU-bound, so files are spread across worker processes
+    with ProcessPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for i in tqdm(range(0, len(new_zip_files), BATCH_SIZE), desc="Processing batches"):
+            batch_files = new_zip_files[i:i + BATCH_SIZE]
+            batch_tables = []
+            
+            results = executor.map(process_zip_file, batch_files, chunksize=1)
+            for table in tqdm(results, total=len(batch_files), desc=f"Batch {batch_count + 1}"):
+                if table is not None:
+                    batch_tables.append(table)
+            
+            # Save or append batch to zarr
+            if batch_tables:
+                if os.path.exists(OUTPUT_ZARR):
+                    logger.info("Appending batch to existing zarr store")
+                    append_to_existing_zarr_fixed(batch_tables, OUTPUT_ZARR, existing_dates)
+                else:
+                    logger.info("Creating new zarr store")
+                    save_flat_dataset_to_zarr(batch_tables, OUTPUT_ZARR)
+            
+            batch_count += 1
+            
+            # Clear memory
+            del batch_tables
+            gc.collect()
     
     logger.info("ZIP to Zarr conversion completed!")
 
@@ -299,8 +346,7 @@ def get_sorted_zip_files():
     if not input_path.exists():
         return []
     
-    zip_files = list(input_path.glob('*.zip'))
-    return sorted(zip_files)
+    return sorted(input_path.glob('*.zip'))
 
 if __name__ == "__main__":
 
@@ -1,14 +1,23 @@
 import os
+import json
 import pandas as pd
 import numpy as np
 import xarray as xr
 import yfinance as yf
 import dask.dataframe as dd
 from itertools import product
-from fs_industry_to_gics_sector_map import fs_industry_to_gic_code, gic_code_to_gic_name
+from fs_industry_to_gics_sector_map import gic_code_to_gic_name, map_fs_to_gics
 import argparse
 import logging
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import shutil
+import zarr
+from zarr_writer import write_columns_to_zarr
+
+# Dashboard aggregations also written as their own stores: store suffix -> pandas offset alias
+# (month/quarter/year use the period-end aliases; 'M'/'Q'/'Y' are deprecated for resampling)
+RESAMPLED_FREQS = {'W': 'W', 'M': 'ME', 'Q': 'QE', 'Y': 'YE'}
 
 def setup_logging():
     """Set up logging configuration."""
@@ -19,10 +28,20 @@ def setup_logging():
     )
     return logging.getLogger(__name__)
 
-def get_latest_date_in_zarr(zarr_path, time_dim='teo'):
-    """Get the latest date from a Zarr store."""
+def get_latest_date_in_zarr(zarr_path, time_dim='teo', time_sorted=False):
+    """Get the latest date from a Zarr store.
+
+    With ``time_sorted=True`` (the store is written in time order, like the
+    zip-to-zarr output) only the last element of ``time_dim`` is read instead
+    of the whole array.
+    """
     try:
-        ds = xr.open_zarr(zarr_path)
+        ds = xr.open_zarr(zarr_path, consolidated=True)
+        
+        if time_sorted and time_dim in ds.variables and ds[time_dim].ndim == 1:
+            if ds[time_dim].size == 0:
+                return None
+            return pd.Timestamp(ds[time_dim].isel({ds[time_dim].dims[0]: -1}).values.item())
         
         # Check if time_dim is a coordinate (dimension)
         if time_dim in ds.dims:
@@ -68,7 +87,8 @@ def check_incremental_processing_needed():
         return True, None, None
     
     # Get latest dates
-    input_latest = get_latest_date_in_zarr(input_zarr_path)
+    # The input store is appended one batch of later dates at a time, sorted by teo
+    input_latest = get_latest_date_in_zarr(input_zarr_path, time_sorted=True)
     output_latest = get_latest_date_in_zarr(output_zarr_path)
     
     logger.info(f"Input dataset latest date: {input_latest}")
@@ -91,32 +111,81 @@ def check_incremental_processing_needed():
         logger.info("No new data to process - input and output datasets are up to date")
         return False, None, None
 
+def get_first_index_on_or_after(zarr_path, start_date, n_rows):
+    """First flat index holding a date >= start_date, from the day-offset sidecar.
+
+    The zip-to-zarr step stores each trading date as one contiguous [start, end)
+    index range in ``<store>_day_offsets.json``. Returns 0 (read everything) when
+    the sidecar is missing or does not cover the whole store.
+    """
+    offsets_path = os.path.splitext(zarr_path)[0] + '_day_offsets.json'
+    if not os.path.exists(offsets_path):
+        return 0
+    with open(offsets_path, 'r') as f:
+        offsets = json.load(f)
+    if sum(end - start for start, end in offsets.values()) != n_rows:
+        return 0
+
+    start_day = pd.Timestamp(start_date).strftime('%Y-%m-%d')
+    starts = [start for day, (start, end) in offsets.items() if day >= start_day]
+    return min(starts) if starts else n_rows
+
 def load_and_filter_data(zarr_path, start_date=None):
     """Load and filter data from zarr, optionally starting from a specific date."""
     logger = logging.getLogger(__name__)
     
     # Load single combined zarr file
-    ds = xr.open_zarr(zarr_path)
+    ds = xr.open_zarr(zarr_path, consolidated=True)
+
+    # Skip the chunks that hold only dates before start_date
+    if start_date is not None:
+        first_index = get_first_index_on_or_after(zarr_path, start_date, ds.sizes['index'])
+        if first_index > 0:
+            # Align down to a chunk boundary so no chunk is read partially
+            chunk_rows = ds.chunks['index'][0]
+            first_index = first_index // chunk_rows * chunk_rows
+            ds = ds.isel(index=slice(first_index, None))
+            logger.info(f"Reading input from index {first_index} onwards")
     
-    # Load and apply liquidity filters
+    # Pull each flat column straight to NumPy and build one boolean mask, so only
+    # surviving rows are ever copied into pandas
     desired_order = ['teo', 'ticker', 'years', 'atmCen', 'atmVol', 'atmVega', 'slope','cCnt','pCnt','vwidth']
-    df_all = ds.to_dataframe().dropna().reset_index()[desired_order]
+    columns = {name: ds[name].values for name in ds.data_vars}
+
+    # Drop rows with a missing value in any column (as dropna() did)
+    mask = np.ones(ds.sizes['index'], dtype=bool)
+    for values in columns.values():
+        mask &= pd.notna(values)
 
     # Filter by date if start_date is provided
     if start_date is not None:
         logger.info(f"Filtering data from {start_date} onwards")
-        df_all = df_all[df_all['teo'] >= start_date]
+        mask &= columns['teo'] >= pd.Timestamp(start_date).to_datetime64()
+
+    # Apply liquidity filters
+    mask &= (
+        (columns['years'] > 0.01) & (columns['years'] < 2) &
+        (columns['atmVol'] < 1.5) &
+        ((columns['cCnt'] + columns['pCnt']) >= 20) &
+        (columns['vwidth'] <= 0.2)
+    )
 
-    df_all = df_all[
-        (df_all['years'] > 0.01) & (df_all['years'] < 2) &
-        (df_all['atmVol'] < 1.5) &
-        ((df_all['cCnt'] + df_all['pCnt']) >= 20) &
-        (df_all['vwidth'] <= 0.2)
-    ]
+    df_all = pd.DataFrame({name: columns[name][mask] for name in desired_order})
     
     logger.info(f"Loaded {len(df_all)} records after filtering")
     return df_all
 
+def write_output_columns(df, output_path, start, mode):
+    """Write or append a flat DataFrame straight to zarr arrays, bypassing to_xarray().
+
+    ``mode='w'`` creates the store, ``mode='a'`` appends to the existing arrays;
+    rows get flat ``index`` values from ``start`` on. The store opens with
+    ``xr.open_zarr`` like one written by xarray.
+    """
+    columns = {'index': np.arange(start, start + len(df), dtype='int64')}
+    columns.update({name: df[name].to_numpy() for name in df.columns})
+    write_columns_to_zarr(columns, output_path, mode)
+
 def append_to_existing_output(new_data, output_path):
     """Append new data to existing output dataset."""
     logger = logging.getLogger(__name__)
@@ -125,60 +194,132 @@ def append_to_existing_output(new_data, output_path):
     if Path(output_path).exists():
         logger.info("Appending to existing flat output dataset")
         try:
-            # Load existing dataset
-            ds_existing = xr.open_zarr(output_path)
-            
-            # Convert existing to dataframe
-            df_existing = ds_existing.to_dataframe().reset_index()
-            
-            # Convert new data to dataframe (it's already a dataframe)
-            df_new = new_data.copy()
-            
-            # Add index to new data
-            if 'index' not in df_new.columns:
-                df_new['index'] = range(len(df_existing), len(df_existing) + len(df_new))
-            
-            # Combine dataframes
-            logger.info("Combining datasets...")
-            df_combined = pd.concat([df_existing, df_new], ignore_index=True)
-            
-            # Remove duplicates if any
-            df_combined = df_combined.drop_duplicates(subset=['teo', 'gics_sector', 'size_category', 'style', 'expiry_label', 'value_type'])
-            
-            # Reset index
-            df_combined['index'] = range(len(df_combined))
-            df_combined = df_combined.set_index('index')
-            
-            # Convert back to xarray
-            ds_combined = df_combined.to_xarray()
-            
-            # Save combined dataset
-            ds_combined.to_zarr(output_path, mode='w')
-            logger.info("Successfully appended new data to existing flat output")
+            key_cols = ['teo', 'gics_sector', 'size_category', 'style', 'expiry_label', 'value_type']
+
+            # Open lazily - only the teo column and the overlapping window are read back
+            ds_existing = xr.open_zarr(output_path, consolidated=True)
+            existing_len = ds_existing.sizes['index']
+
+            df_new = new_data.drop_duplicates(subset=key_cols)
+
+            # Remove rows already stored (existing rows win, as before)
+            overlap = np.flatnonzero(ds_existing['teo'].values >= df_new['teo'].min().to_datetime64())
+            if len(overlap) > 0:
+                df_overlap = ds_existing[key_cols].isel(index=overlap).to_dataframe().drop_duplicates()
+                df_new = df_new.merge(df_overlap, on=key_cols, how='left', indicator=True)
+                df_new = df_new[df_new['_merge'] == 'left_only'].drop(columns=['_merge'])
+
+            if len(df_new) == 0:
+                logger.info("No new records to append - output is already up to date")
+                return
+
+            # Continue the flat index and append only the new rows
+            write_output_columns(df_new, output_path, existing_len, mode='a')
+            logger.info(f"Successfully appended {len(df_new)} new records to existing flat output")
             
         except Exception as e:
             logger.error(f"Error appending to existing dataset: {e}")
             logger.info("Falling back to creating new dataset with only new data")
             # Create flat structure for new data only (don't overwrite existing)
-            df_new = new_data.copy()
-            df_new['index'] = range(len(df_new))
-            df_new = df_new.set_index('index')
-            ds_new = df_new.to_xarray()
             # Use a temporary path to avoid overwriting existing data
             temp_output_path = output_path + '.temp'
-            ds_new.to_zarr(temp_output_path, mode='w')
+            write_output_columns(new_data, temp_output_path, 0, mode='w')
             logger.warning(f"Created temporary dataset at {temp_output_path} - manual intervention may be needed")
             logger.warning("Original dataset preserved at original location")
     else:
         logger.info("Creating new flat output dataset")
         # Create flat structure for new data
-        df_new = new_data.copy()
-        df_new['index'] = range(len(df_new))
-        df_new = df_new.set_index('index')
-        ds_new = df_new.to_xarray()
-        ds_new.to_zarr(output_path, mode='w')
+        write_output_columns(new_data, output_path, 0, mode='w')
         logger.info("Successfully created new flat output dataset")
 
+def write_resampled_outputs(output_path, since=None):
+    """Update the sibling stores holding the output pre-aggregated to each of RESAMPLED_FREQS.
+
+    Each store (``<output>_W.zarr`` etc.) has the mean weighted_value per label
+    combination and period, as the dashboard would resample it, with rows in teo
+    order. Only periods holding days from ``since`` on are recomputed: their rows
+    are dropped from the store and re-appended from the daily rows of those
+    periods. Stores that do not exist yet, or ``since=None``, are built from the
+    full daily store.
+    """
+    logger = logging.getLogger(__name__)
+    label_cols = ['gics_sector', 'size_category', 'style', 'expiry_label', 'value_type']
+
+    # First touched period per store (None = rebuild); the store suffix is also the Period code
+    cutoffs = {}
+    for freq in RESAMPLED_FREQS:
+        resampled_path = output_path.replace('.zarr', f'_{freq}.zarr')
+        if since is not None and Path(resampled_path).exists():
+            cutoffs[freq] = pd.Period(since, freq).start_time
+        else:
+            cutoffs[freq] = None
+
+    # Read back only the daily rows of the touched periods (all of them if any store is rebuilt)
+    ds = xr.open_zarr(output_path, consolidated=True)
+    teo = ds['teo'].values
+    earliest = None if None in cutoffs.values() else min(cutoffs.values())
+    if earliest is not None:
+        ds = ds.isel(index=np.flatnonzero(teo >= earliest.to_datetime64()))
+    daily = pd.DataFrame({c: ds[c].values for c in ['teo'] + label_cols + ['weighted_value']})
+    daily = daily.dropna(subset=['weighted_value'])
+    for c in label_cols:
+        daily[c] = daily[c].astype('category')
+
+    for freq, offset in RESAMPLED_FREQS.items():
+        cutoff = cutoffs[freq]
+        rows = daily if cutoff is None else daily[daily['teo'] >= cutoff]
+        resampled = (
+            rows
+            .groupby(label_cols + [pd.Grouper(key='teo', freq=offset)], observed=True)
+            ['weighted_value'].mean()
+            .reset_index()
+            .sort_values('teo', kind='stable')
+        )
+        for c in label_cols:
+            resampled[c] = resampled[c].astype(str)
+        resampled = resampled[['teo'] + label_cols + ['weighted_value']]
+        resampled_path = output_path.replace('.zarr', f'_{freq}.zarr')
+
+        if cutoff is None:
+            write_output_columns(resampled, resampled_path, 0, mode='w')
+            logger.info(f"Wrote {len(resampled)} {freq} records to {resampled_path}")
+            continue
+
+        try:
+            # Period labels are the period ends, so rows of touched periods have teo >= cutoff
+            existing = xr.open_zarr(resampled_path, consolidated=True)
+            keep = existing['teo'].values < cutoff.to_datetime64()
+            n_keep = int(keep.sum())
+            if keep[:n_keep].all():
+                # Touched periods are the tail: drop them and append the recomputed ones
+                root = zarr.open_group(resampled_path, mode='a')
+                for name in root.array_keys():
+                    root[name].resize((n_keep,))
+                write_output_columns(resampled, resampled_path, n_keep, mode='a')
+            else:
+                # Store from before rows were kept in teo order - rewrite it once, sorted
+                kept = existing[['teo'] + label_cols + ['weighted_value']].isel(index=np.flatnonzero(keep))
+                kept = kept.to_dataframe().reset_index(drop=True)
+                combined = pd.concat([kept, resampled], ignore_index=True).sort_values('teo', kind='stable')
+                write_output_columns(combined, resampled_path, 0, mode='w')
+            logger.info(f"Updated {len(resampled)} {freq} records from {cutoff.date()} on in {resampled_path}")
+        except Exception as e:
+            # Remove the store rather than leave it partly updated: the dashboard then resamples
+            # the daily rows itself, and the next run rebuilds the store in full
+            logger.error(f"Error updating {resampled_path}: {e} - removing it for a full rebuild")
+            shutil.rmtree(resampled_path, ignore_errors=True)
+
+def forward_vols(pivot, target_days):
+    """Add fwd_{T1}_{T2} columns for each consecutive pair of target days."""
+    V = pivot[target_days].to_numpy(np.float64)
+    T = np.asarray(target_days, dtype=np.float64) / 365.0
+    # Negative forward variance yields NaN, as it did with the per-column pandas version
+    with np.errstate(invalid='ignore'):
+        F = np.sqrt((V[:, 1:]**2 * T[1:] - V[:, :-1]**2 * T[:-1]) / (T[1:] - T[:-1]))
+    cols = [f'fwd_{a}_{b}' for a, b in zip(target_days[:-1], target_days[1:])]
+    pivot[cols] = F
+    return pivot
+
 def main():
     """Main function with incremental processing logic."""
     parser = argparse.ArgumentParser(description='Produce IV dataset with incremental processing')
@@ -231,23 +372,22 @@ def main():
 
     # 1. Filter to expiries closest to target days
     TARGET_DAYS = [30, 60, 90, 120, 180, 270, 360, 540, 720]
-    def assign_closest_bucket(years):
-        days = years * 365.0
-        diffs = [abs(days - tgt) for tgt in TARGET_DAYS]
-        idx = int(np.argmin(diffs))
-        return TARGET_DAYS[idx], diffs[idx]
-
-    df_all[['target_days', 'days_diff']] = pd.DataFrame(
-        df_all['years'].apply(assign_closest_bucket).tolist(),
-        index=df_all.index
-    )
 
-    df_all = (
-        df_all.sort_values('days_diff')
-        .groupby(['teo', 'ticker', 'target_days'], as_index=False)
-        .first()
-        .drop(columns=['days_diff'])
+    # Closest target = bucket between consecutive midpoints (ties go to the shorter target)
+    td = np.asarray(TARGET_DAYS, dtype=np.float64)
+    mids = (td[:-1] + td[1:]) / 2
+    days = df_all['years'].to_numpy(dtype=np.float64) * 365.0
+    target_days = td[np.searchsorted(mids, days)]
+    df_all['target_days'] = target_days.astype(np.int32)
+    df_all['days_diff'] = np.abs(days - target_days)
+
+    # Keep the expiry closest to each target per (teo, ticker) without a global sort
+    keep_idx = (
+        df_all.groupby(['teo', 'ticker', 'target_days'], sort=False)['days_diff']
+        .idxmin()
+        .to_numpy()
     )
+    df_all = df_all.loc[keep_idx].drop(columns=['days_diff'])
 
     # Pivot both atmVol and atmCen
     pivot_vol = df_all.pivot(index=['teo', 'ticker'], columns='target_days', values='atmVol').reset_index()
@@ -256,119 +396,91 @@ def main():
     # Define forward pairs
     TARGET_PAIRS = list(zip(TARGET_DAYS[:-1], TARGET_DAYS[1:]))
 
-    # Calculate forward vols for atmVol
-    for T1d, T2d in TARGET_PAIRS:
-        T1 = T1d / 365.0
-        T2 = T2d / 365.0
-        col1 = T1d
-        col2 = T2d
-        new_col = f'fwd_{T1d}_{T2d}'
-        pivot_vol[new_col] = np.sqrt(
-            (pivot_vol[col2]**2 * T2 - pivot_vol[col1]**2 * T1) / (T2 - T1)
-        )
-
-    # Calculate forward vols for atmCen (same logic for symmetry)
-    for T1d, T2d in TARGET_PAIRS:
-        T1 = T1d / 365.0
-        T2 = T2d / 365.0
-        col1 = T1d
-        col2 = T2d
-        new_col = f'fwd_{T1d}_{T2d}'
-        pivot_cen[new_col] = np.sqrt(
-            (pivot_cen[col2]**2 * T2 - pivot_cen[col1]**2 * T1) / (T2 - T1)
-        )
+    # Calculate forward vols for atmVol and atmCen (same logic for symmetry)
+    pivot_vol = forward_vols(pivot_vol, TARGET_DAYS)
+    pivot_cen = forward_vols(pivot_cen, TARGET_DAYS)
 
     # Define column lists
     vol_cols = TARGET_DAYS
     fwd_cols = [f'fwd_{T1}_{T2}' for T1, T2 in TARGET_PAIRS]
 
-    # Melt atmVol (including forward vols)
-    vol_melt = pivot_vol.melt(
-        id_vars=['teo', 'ticker'],
-        value_vars=vol_cols + fwd_cols,
-        var_name='expiry_label',
-        value_name='value'
-    )
-    vol_melt['value_type'] = 'atmVol'
-
-    # Melt atmCen (including forward vols)
-    cen_melt = pivot_cen.melt(
-        id_vars=['teo', 'ticker'],
-        value_vars=vol_cols + fwd_cols,
-        var_name='expiry_label',
-        value_name='value'
-    )
-    cen_melt['value_type'] = 'atmCen'
-
-    # Combine and clean
-    df_melt = pd.concat([vol_melt, cen_melt], ignore_index=True).dropna()
-
-    ds_all = df_melt.set_index(['teo', 'ticker', 'expiry_label', 'value_type'])[['value']].to_xarray()
+    # Build the combined long form (atmVol then atmCen) in one allocation instead of melt + melt + concat.
+    # Both pivots come from the same (teo, ticker) index, so their rows line up.
+    value_cols = vol_cols + fwd_cols
+    V = pivot_vol[value_cols].to_numpy(np.float64)
+    C = pivot_cen[value_cols].to_numpy(np.float64)
+    n, k = V.shape
+    df_melt = pd.DataFrame({
+        'teo': np.tile(np.repeat(pivot_vol['teo'].to_numpy(), k), 2),
+        'ticker': np.tile(np.repeat(pivot_vol['ticker'].to_numpy(), k), 2),
+        'expiry_label': np.tile(np.asarray(value_cols, dtype=object), 2 * n),
+        'value_type': np.repeat(np.array(['atmVol', 'atmCen'], dtype=object), n * k),
+        'value': np.concatenate([V.ravel(), C.ravel()]),
+    }).dropna(subset=['value'])
 
     # First run this in terminal: gsutil -m cp -r gs://rm_api_data/ds_daily_ticker.zarr .
-    # Load daily ticker dataset
-    ds_daily_ticker = xr.open_zarr('C:/Users/gigan/OneDrive/Desktop/BlueWaterMacro/data/stock_data/zarr/ds_daily_ticker.zarr').compute()
+    # Load daily ticker and style datasets concurrently so the GCS read overlaps the local one;
+    # only the variables used below are read from either store
+    style_zarr_path = 'gs://rm_api_data/symbol_style_time.zarr'
+    style_vars = ['ticker', 'Aggressive_Growth', 'Growth', 'Value', 'Deep_Value', 'GARP', 'Yield']
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        ticker_future = executor.submit(
+            lambda: xr.open_zarr('C:/Users/gigan/OneDrive/Desktop/BlueWaterMacro/data/stock_data/zarr/ds_daily_ticker.zarr')[['fs_industry_code', 'mktcap']].compute()
+        )
+        style_future = executor.submit(
+            lambda: xr.open_zarr(style_zarr_path, storage_options={"token": None})[style_vars].compute()
+        )
+        ds_daily_ticker, style_ds = ticker_future.result(), style_future.result()
 
-    ds_all['teo'] = ds_all['teo'].astype('datetime64[D]')
     ds_daily_ticker['teo'] = ds_daily_ticker['teo'].astype('datetime64[D]')
-
-    ds_dates = np.unique(ds_all.teo.values)
-    teo_dates = np.unique(ds_daily_ticker.teo.values)
-    common_teo = np.intersect1d(ds_dates, teo_dates)
-
-    tickers_ds = np.unique(ds_all.ticker.values)
-    tickers_daily = np.unique(ds_daily_ticker.ticker.values)
-    common_tickers = np.intersect1d(tickers_ds, tickers_daily)
-
-    ds_trimmed = ds_all.sel(
-        teo=common_teo,
-        ticker=common_tickers
-    )
-
-    ds_ticker_trimmed = ds_daily_ticker.sel(
-        teo=common_teo,
-        ticker=common_tickers
+    df_melt['teo'] = df_melt['teo'].dt.normalize()
+
+    # One shared ticker categorical for every frame joined on (teo, ticker), so the merges
+    # compare int codes; tickers outside df_melt could never match and become NaN
+    ticker_dtype = pd.CategoricalDtype(np.sort(df_melt['ticker'].unique()))
+    df_melt['ticker'] = df_melt['ticker'].astype(ticker_dtype)
+
+    # Attach industry codes in long form; the inner join keeps only (teo, ticker) pairs present in both
+    industry_df = ds_daily_ticker['fs_industry_code'].to_series().dropna().reset_index()
+    industry_df['ticker'] = industry_df['ticker'].astype(ticker_dtype)
+    industry_df = industry_df.dropna(subset=['ticker'])
+    df = df_melt.merge(industry_df, on=['teo', 'ticker'], how='inner').dropna(subset=['fs_industry_code', 'value'])
+
+    # Carry int8 GICS codes (-1 where unmapped) and only wrap them in the sector names
+    # as a categorical, so the column never holds per-row Python strings
+    gics_codes = map_fs_to_gics(df['fs_industry_code'].to_numpy().astype(np.int32))
+    df = df[gics_codes >= 0]
+    gics_codes = gics_codes[gics_codes >= 0]
+    gic_codes = np.array(sorted(gic_code_to_gic_name))
+    df['gics_sector'] = pd.Categorical.from_codes(
+        np.searchsorted(gic_codes, gics_codes),
+        categories=[gic_code_to_gic_name[c] for c in gic_codes]
     )
 
-    industry_codes = ds_ticker_trimmed['fs_industry_code']
-    ds_trimmed = ds_trimmed.assign_coords(fs_industry_code=(('teo', 'ticker'), industry_codes.values))
-    df = ds_trimmed.to_dataframe().reset_index().dropna(subset=['fs_industry_code', 'value'])
-
-    df['fs_industry_code'] = df['fs_industry_code'].astype(int)
-    df['gics_sector_code'] = df['fs_industry_code'].map(fs_industry_to_gic_code)
-    df['gics_sector'] = df['gics_sector_code'].map(gic_code_to_gic_name)
-    df = df.dropna(subset=['gics_sector_code', 'gics_sector'])
-
     mktcap_df = ds_daily_ticker['mktcap'].to_series().reset_index()
     mktcap_df.columns = ['teo', 'ticker', 'market_cap']
+    mktcap_df['ticker'] = mktcap_df['ticker'].astype(ticker_dtype)
+    mktcap_df = mktcap_df.dropna(subset=['ticker'])
     df['teo'] = pd.to_datetime(df['teo'])
     mktcap_df['teo'] = pd.to_datetime(mktcap_df['teo'])
     df = df.merge(mktcap_df, on=['teo', 'ticker'], how='left')
 
-    def classify_size(market_cap):
-        if market_cap >= 10e9:
-            return 'Large Cap'
-        elif market_cap >= 2e9:
-            return 'Mid Cap'
-        else:
-            return 'Small Cap'
-
-    df['size_category'] = df['market_cap'].apply(classify_size)
-
-    style_zarr_path = 'gs://rm_api_data/symbol_style_time.zarr'
-    style_ds = xr.open_zarr(style_zarr_path, storage_options={"token": None})
+    # Size buckets: >= 10B Large, >= 2B Mid, everything else (including missing caps) Small
+    df['size_category'] = pd.cut(
+        df['market_cap'],
+        bins=[-np.inf, 2e9, 10e9, np.inf],
+        labels=['Small Cap', 'Mid Cap', 'Large Cap'],
+        right=False
+    ).fillna('Small Cap')
 
     # Step 1: Extract raw ticker values (symbol x teo)
     ticker_2d = style_ds['ticker'].values
 
-    # Step 2: Extract first valid ticker per symbol
-    def first_valid_ticker(row):
-        for val in row:
-            if isinstance(val, str) and val.strip() != '':
-                return val
-        return None
-
-    ticker_1d = np.array([first_valid_ticker(row) for row in ticker_2d])
+    # Step 2: Extract first valid (non-blank string) ticker per symbol
+    stripped = pd.Series(ticker_2d.ravel(), dtype=object).str.strip()
+    valid = (stripped.notna() & stripped.ne('')).to_numpy().reshape(ticker_2d.shape)
+    first_idx = valid.argmax(axis=1)
+    ticker_1d = np.where(valid.any(axis=1), ticker_2d[np.arange(len(ticker_2d)), first_idx], None)
 
     # Step 3: Drop rows with missing ticker
     valid_mask = pd.notnull(ticker_1d)
@@ -381,6 +493,10 @@ def main():
 
     style_df = style_ds[['Aggressive_Growth', 'Growth', 'Value', 'Deep_Value', 'GARP', 'Yield']].to_dataframe().reset_index()
 
+    # Shared ticker codes sort and deduplicate much faster than object tickers
+    style_df['ticker'] = style_df['ticker'].astype(ticker_dtype)
+    style_df = style_df.dropna(subset=['ticker'])
+
     # Melt style columns into long format
     style_melted = style_df.melt(
         id_vars=['teo', 'ticker'],
@@ -399,44 +515,47 @@ def main():
     # Step 1: Drop style_score
     style_ranked = style_ranked.drop(columns=['style_score'])
 
-    # Step 2: Ensure teo is datetime and sorted
-    style_ranked['teo'] = pd.to_datetime(style_ranked['teo'])
-    style_ranked = style_ranked.sort_values(['ticker', 'teo'])
-
-    # Step 3: Reindex to daily frequency per ticker
-    all_days = pd.date_range(style_ranked['teo'].min(), style_ranked['teo'].max(), freq='D')
-
-    # Create a MultiIndex of all (ticker, date) combinations
-    tickers = style_ranked['ticker'].unique()
-    full_index = pd.MultiIndex.from_product([tickers, all_days], names=['ticker', 'teo'])
-
-    # Reindex and forward-fill
-    style_daily = (
-        style_ranked
-        .set_index(['ticker', 'teo'])
-        .reindex(full_index)
-        .groupby(level=0)
-        .ffill()
-        .reset_index()
-    )
+    # Step 2: Ensure teo is datetime and sorted (merge_asof needs both sides sorted on teo)
+    style_ranked['teo'] = pd.to_datetime(style_ranked['teo']).astype('datetime64[ns]')
+    style_ranked = style_ranked.sort_values('teo')
+    df['teo'] = pd.to_datetime(df['teo']).astype('datetime64[ns]')
+    df = df.sort_values('teo')
 
-    df['teo'] = pd.to_datetime(df['teo'])
-    style_daily['teo'] = pd.to_datetime(style_daily['teo'])
-    df = df.merge(style_daily, on=['ticker', 'teo'], how='left')
+    # Step 3: Carry the last known style forward to each (ticker, teo) without a dense daily grid
+    df = pd.merge_asof(df, style_ranked, on='teo', by='ticker', direction='backward')
+
+    # The daily grid used to stop at the last style date, so leave later dates unassigned
+    df.loc[df['teo'] > style_ranked['teo'].max(), 'style'] = np.nan
 
     # Step 1: Daskify the data
+    # Categorical group keys hash as int codes; 'Total' is reserved up front so the
+    # total rows below keep the same dtype as the detail rows
+    df['expiry_label'] = df['expiry_label'].astype(str)
+    for c in ['gics_sector', 'size_category', 'style', 'expiry_label', 'value_type']:
+        df[c] = df[c].astype('category')
+    for c in ['gics_sector', 'size_category', 'style']:
+        df[c] = df[c].cat.add_categories(['Total'])
+    key_dtypes = {c: df[c].dtype for c in ['gics_sector', 'size_category', 'style']}
+
+    def mark_total(frame, *total_cols):
+        for c in total_cols:
+            frame[c] = 'Total'
+            frame[c] = frame[c].astype(key_dtypes[c])
+
+    # float32 halves partition size; the weighted numerator below stays float32 too
+    df['value'] = df['value'].astype('float32')
+    df['market_cap'] = df['market_cap'].astype('float32')
+
     cols = ['teo', 'gics_sector', 'size_category', 'style', 'expiry_label', 'value_type', 'value', 'market_cap']
     ddf = dd.from_pandas(df[cols], npartitions=32)
 
     # Step 2: Add weighted numerator
     ddf['weighted_value_num'] = ddf['value'] * ddf['market_cap']
 
-    # Step 3: Full-detail group
+    # Step 3: Full-detail group (NaN keys are kept here so the totals below still count those rows)
     group_cols = ['teo', 'gics_sector', 'size_category', 'style', 'expiry_label', 'value_type']
-    grouped = ddf.groupby(group_cols)
-    agg_main = grouped[['weighted_value_num', 'market_cap']].sum().reset_index()
-    agg_main['weighted_value'] = agg_main['weighted_value_num'] / agg_main['market_cap']
-    agg_main = agg_main.drop(columns=['weighted_value_num', 'market_cap'])
+    grouped = ddf.groupby(group_cols, observed=True, dropna=False)
+    agg_main = grouped[['weighted_value_num', 'market_cap']].sum().reset_index().compute()
 
     '''
     Example:
@@ -452,94 +571,34 @@ def main():
     stocks with that expiry on that day.
     '''
 
-    # Step 4: Compute true totals for each axis (by dropping one at a time)
-    agg_totals = []
-
-    # Add full total (across all 3: sector, size, style)
-    total_all = (
-        ddf.groupby(['teo', 'expiry_label', 'value_type'])[['weighted_value_num', 'market_cap']]
-        .sum()
-        .reset_index()
-    )
-    total_all['gics_sector'] = 'Total'
-    total_all['size_category'] = 'Total'
-    total_all['style'] = 'Total'
-    total_all['weighted_value'] = total_all['weighted_value_num'] / total_all['market_cap']
-    total_all = total_all.drop(columns=['weighted_value_num', 'market_cap'])
-    agg_totals.append(total_all)
-
-    # Add partial totals - sector total (size and style as-is)
-    total_sector = (
-        ddf.groupby(['teo', 'size_category', 'style', 'expiry_label', 'value_type'])[['weighted_value_num', 'market_cap']]
-        .sum()
-        .reset_index()
-    )
-    total_sector['gics_sector'] = 'Total'
-    total_sector['weighted_value'] = total_sector['weighted_value_num'] / total_sector['market_cap']
-    total_sector = total_sector.drop(columns=['weighted_value_num', 'market_cap'])
-    agg_totals.append(total_sector)
-
-    # Add partial totals - size total (sector and style as-is)
-    total_size = (
-        ddf.groupby(['teo', 'gics_sector', 'style', 'expiry_label', 'value_type'])[['weighted_value_num', 'market_cap']]
-        .sum()
-        .reset_index()
-    )
-    total_size['size_category'] = 'Total'
-    total_size['weighted_value'] = total_size['weighted_value_num'] / total_size['market_cap']
-    total_size = total_size.drop(columns=['weighted_value_num', 'market_cap'])
-    agg_totals.append(total_size)
-
-    # Add partial totals - style total (sector and size as-is)
-    total_style = (
-        ddf.groupby(['teo', 'gics_sector', 'size_category', 'expiry_label', 'value_type'])[['weighted_value_num', 'market_cap']]
-        .sum()
-        .reset_index()
-    )
-    total_style['style'] = 'Total'
-    total_style['weighted_value'] = total_style['weighted_value_num'] / total_style['market_cap']
-    total_style = total_style.drop(columns=['weighted_value_num', 'market_cap'])
-    agg_totals.append(total_style)
-
-    # Add partial totals - sector and size total (style as-is)
-    total_sector_size = (
-        ddf.groupby(['teo', 'style', 'expiry_label', 'value_type'])[['weighted_value_num', 'market_cap']]
-        .sum()
-        .reset_index()
-    )
-    total_sector_size['gics_sector'] = 'Total'
-    total_sector_size['size_category'] = 'Total'
-    total_sector_size['weighted_value'] = total_sector_size['weighted_value_num'] / total_sector_size['market_cap']
-    total_sector_size = total_sector_size.drop(columns=['weighted_value_num', 'market_cap'])
-    agg_totals.append(total_sector_size)
-
-    # Add partial totals - sector and style total (size as-is)
-    total_sector_style = (
-        ddf.groupby(['teo', 'size_category', 'expiry_label', 'value_type'])[['weighted_value_num', 'market_cap']]
-        .sum()
-        .reset_index()
-    )
-    total_sector_style['gics_sector'] = 'Total'
-    total_sector_style['style'] = 'Total'
-    total_sector_style['weighted_value'] = total_sector_style['weighted_value_num'] / total_sector_style['market_cap']
-    total_sector_style = total_sector_style.drop(columns=['weighted_value_num', 'market_cap'])
-    agg_totals.append(total_sector_style)
-
-    # Add partial totals - size and style total (sector as-is)
-    total_size_style = (
-        ddf.groupby(['teo', 'gics_sector', 'expiry_label', 'value_type'])[['weighted_value_num', 'market_cap']]
-        .sum()
-        .reset_index()
-    )
-    total_size_style['size_category'] = 'Total'
-    total_size_style['style'] = 'Total'
-    total_size_style['weighted_value'] = total_size_style['weighted_value_num'] / total_size_style['market_cap']
-    total_size_style = total_size_style.drop(columns=['weighted_value_num', 'market_cap'])
-    agg_totals.append(total_size_style)
+    # Step 4: Compute true totals for each axis by marginalizing agg_main (no extra passes over ddf)
+    def rollup(keep_cols, total_cols):
+        g = agg_main.groupby(keep_cols, observed=True, as_index=False)[['weighted_value_num', 'market_cap']].sum()
+        mark_total(g, *total_cols)
+        return g
+
+    agg_totals = [
+        # Full total (across all 3: sector, size, style)
+        rollup(['teo', 'expiry_label', 'value_type'], ['gics_sector', 'size_category', 'style']),
+        # Partial totals - sector total (size and style as-is)
+        rollup(['teo', 'size_category', 'style', 'expiry_label', 'value_type'], ['gics_sector']),
+        # Partial totals - size total (sector and style as-is)
+        rollup(['teo', 'gics_sector', 'style', 'expiry_label', 'value_type'], ['size_category']),
+        # Partial totals - style total (sector and size as-is)
+        rollup(['teo', 'gics_sector', 'size_category', 'expiry_label', 'value_type'], ['style']),
+        # Partial totals - sector and size total (style as-is)
+        rollup(['teo', 'style', 'expiry_label', 'value_type'], ['gics_sector', 'size_category']),
+        # Partial totals - sector and style total (size as-is)
+        rollup(['teo', 'size_category', 'expiry_label', 'value_type'], ['gics_sector', 'style']),
+        # Partial totals - size and style total (sector as-is)
+        rollup(['teo', 'gics_sector', 'expiry_label', 'value_type'], ['size_category', 'style']),
+    ]
 
-    # Step 5: Combine all Dask pieces and compute
-    agg_all = dd.concat([agg_main] + agg_totals)
-    agg_all = agg_all.compute()
+    # Step 5: Combine all pieces and compute weighted values
+    agg_main = agg_main.dropna(subset=group_cols)
+    agg_all = pd.concat([agg_main] + agg_totals, ignore_index=True)
+    agg_all['weighted_value'] = agg_all['weighted_value_num'] / agg_all['market_cap']
+    agg_all = agg_all.drop(columns=['weighted_value_num', 'market_cap'])
 
     # Step 6: Final prep and save
     for col in ['gics_sector', 'size_category', 'style', 'expiry_label', 'value_type']:
@@ -554,16 +613,17 @@ def main():
     if not output_exists:
         # Create new flat dataset only if output doesn't exist
         logger.info(f"Creating new output dataset at {output_path}")
-        df_new = agg_all.copy()
-        df_new['index'] = range(len(df_new))
-        df_new = df_new.set_index('index')
-        ds_total = df_new.to_xarray()
-        ds_total.to_zarr(output_path, mode='w')
+        write_output_columns(agg_all, output_path, 0, mode='w')
         logger.info("Created new flat output dataset")
     else:
         # Always append to existing dataset if it exists (regardless of --force flag)
         logger.info(f"Appending {len(agg_all)} new records to existing dataset at {output_path}")
         append_to_existing_output(agg_all, output_path)
+
+    # Pre-aggregate for the dashboard's weekly/monthly/quarterly/yearly views, recomputing
+    # only the periods that received new days when the output already existed
+    since = agg_all['teo'].min() if output_exists else None
+    write_resampled_outputs(output_path, since=since if pd.notna(since) else None)
     
     logger.info("IV dataset production completed successfully")
     return 0
@@ -9,12 +9,12 @@ Usage:
     python 2b_upload_to_gc.py
 
 Dependencies:
-    - gsutil (Google Cloud SDK)
-    - gcsfs: For GCP filesystem operations
+    - gcsfs: For GCP filesystem operations and uploads
     - xarray: For data verification
 """
 
-import subprocess
+import base64
+import hashlib
 import logging
 from pathlib import Path
 import yaml
@@ -47,6 +47,44 @@ def get_aggregated_iv_zarr_path():
     """Get the local zarr path for the aggregated IV cross totals dataset."""
     return Path("output/aggregated_iv_cross_with_totals.zarr")
 
+def get_changed_files(gcs, local_zarr_path, gcp_url):
+    """List local files that are missing in GCP or differ from the uploaded copy.
+
+    Sizes are compared first; equal-sized files are compared by MD5, so unchanged
+    chunks are never re-sent (as gsutil rsync did).
+    """
+    remote_root = gcp_url[len('gs://'):].rstrip('/')
+    try:
+        remote = gcs.find(remote_root, detail=True)
+    except FileNotFoundError:
+        remote = {}
+
+    changed = []
+    for local_file in local_zarr_path.rglob('*'):
+        if not local_file.is_file():
+            continue
+        remote_path = f"{remote_root}/{local_file.relative_to(local_zarr_path).as_posix()}"
+        info = remote.get(remote_path)
+        if info is None or int(info.get('size', -1)) != local_file.stat().st_size:
+            changed.append((str(local_file), remote_path))
+            continue
+        local_md5 = base64.b64encode(hashlib.md5(local_file.read_bytes()).digest()).decode()
+        if info.get('md5Hash') != local_md5:
+            changed.append((str(local_file), remote_path))
+    return changed
+
+def sync_zarr_to_gcp(gcs, local_zarr_path, gcp_url):
+    """Upload only the changed files of a local zarr store, in parallel, via gcsfs."""
+    changed = get_changed_files(gcs, local_zarr_path, gcp_url)
+    if not changed:
+        logger.info("GCP store is already up to date - nothing to upload")
+        return
+    
+    logger.info(f"Uploading {len(changed)} changed files to {gcp_url}")
+    local_paths, remote_paths = zip(*changed)
+    # gcsfs issues list puts concurrently
+    gcs.put(list(local_paths), list(remote_paths))
+
 def upload_surface_curve_to_gcp():
     """Upload the surface curve history zarr store to GCP."""
     try:
@@ -77,15 +115,8 @@ def upload_surface_curve_to_gcp():
             gcp_exists = False
             logger.info("No existing zarr store found in GCP - will create new one")
         
-        # Use gsutil to sync the local zarr to GCP (this will replace existing)
-        cmd = f"gsutil -m rsync -r {local_zarr_path} {gcp_url}"
-        logger.info(f"Running: {cmd}")
-        result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-        
-        if result.returncode != 0:
-            logger.error(f"Error during gsutil rsync: {result.stderr}")
-            logger.error(f"Command output: {result.stdout}")
-            raise RuntimeError("Failed to sync zarr store to GCP")
+        # Sync the local zarr to GCP (changed files only; this will replace existing)
+        sync_zarr_to_gcp(gcs, local_zarr_path, gcp_url)
         
         logger.info("Successfully synced surface curve history zarr store to GCP")
         
@@ -134,15 +165,8 @@ def upload_aggregated_iv_to_gcp():
             gcp_exists = False
             logger.info("No existing aggregated IV zarr store found in GCP - will create new one")
         
-        # Use gsutil to sync the local zarr to GCP (this will replace existing)
-        cmd = f"gsutil -m rsync -r {local_zarr_path} {gcp_url}"
-        logger.info(f"Running: {cmd}")
-        result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
-        
-        if result.returncode != 0:
-            logger.error(f"Error during gsutil rsync: {result.stderr}")
-            logger.error(f"Command output: {result.stdout}")
-            raise RuntimeError("Failed to sync aggregated IV zarr store to GCP")
+        # Sync the local zarr to GCP (changed files only; this will replace existing)
+        sync_zarr_to_gcp(gcs, local_zarr_path, gcp_url)
         
         logger.info("Successfully synced aggregated IV zarr store to GCP")
         
@@ -1,22 +1,29 @@
 import streamlit as st
 import xarray as xr
 import pandas as pd
+import numpy as np
 import plotly.express as px
+import plotly.graph_objects as go
 import yfinance as yf
 import io
+import os
+from joblib import Parallel, delayed
 
 st.set_page_config(layout="wide")
 st.title("Implied Volatility Dashboard")
 
-@st.cache_data
-def load_vix():
+# Hash frames with pandas' vectorized row hashing instead of Streamlit's generic hashing
+FRAME_HASH_FUNCS = {pd.DataFrame: lambda d: pd.util.hash_pandas_object(d, index=False).values.tobytes()}
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def load_vix(start, end, freq):
+    """VIX closes (as a fraction) between start and end inclusive, resampled to freq."""
     try:
-        vix = yf.download("^VIX", start=df["teo"].min(), end=df["teo"].max())
+        vix = yf.download("^VIX", start=start, end=end + pd.Timedelta(days=1))
         if vix is not None and not vix.empty:
-            vix = vix[["Close"]].rename(columns={"Close": "VIX"})/100
-            vix = vix.reset_index()
-            vix.columns = ["Date", "VIX"]
-            return vix
+            vix = vix[["Close"]]/100
+            vix.columns = ["VIX"]
+            return vix.resample(RESAMPLE_RULES[freq]).mean().rename_axis("Date").reset_index()
         else:
             return pd.DataFrame(columns=["Date", "VIX"])
     except Exception as e:
@@ -24,19 +31,63 @@ def load_vix():
         return pd.DataFrame(columns=["Date", "VIX"])
 
 
-@st.cache_data
-def load_data():
-    ds = xr.open_zarr("output/aggregated_iv_cross_with_totals_flat.zarr")
-    df = ds.to_dataframe().reset_index().dropna(subset=["weighted_value"])
-    df["teo"] = pd.to_datetime(df["teo"])
+OUTPUT_STORE = "output/aggregated_iv_cross_with_totals_flat.zarr"
 
-    # Clean labels
-    df["gics_sector"] = df["gics_sector"].str.replace("_", " ")
-    df["size_category"] = df["size_category"].str.replace("_", " ")
-    df["style"] = df["style"].str.replace("_", " ")
+def store_path(freq):
+    """Daily output store, or its sibling pre-aggregated to freq by the production script."""
+    return OUTPUT_STORE if freq == "D" else OUTPUT_STORE.replace(".zarr", f"_{freq}.zarr")
+
+@st.cache_data
+def load_data(path=OUTPUT_STORE):
+    ds = xr.open_zarr(path, consolidated=True)
+
+    # Read only the columns the dashboard uses and drop empty values before building the frame
+    columns = ["teo", "gics_sector", "size_category", "style", "expiry_label", "value_type", "weighted_value"]
+    values = {c: ds[c].values for c in columns}
+    keep = ~np.isnan(values["weighted_value"])
+    df = pd.DataFrame({c: v[keep] for c, v in values.items()})
+    # xarray decodes the CF time units, so teo is normally datetime64 already
+    if not np.issubdtype(df["teo"].dtype, np.datetime64):
+        df["teo"] = pd.to_datetime(df["teo"], format="%Y-%m-%d")
+
+    # Low-cardinality labels as categoricals: int codes for the filters and groupby
+    for c in ["gics_sector", "size_category", "style", "expiry_label", "value_type"]:
+        df[c] = df[c].astype("category")
+
+    # Clean labels on the categories rather than on every row, keeping them sorted for the filters
+    for c in ["gics_sector", "size_category", "style", "expiry_label"]:
+        df[c] = df[c].cat.rename_categories({k: k.replace("_", " ") for k in df[c].cat.categories})
+        df[c] = df[c].cat.reorder_categories(sorted(df[c].cat.categories))
 
     return df
 
+@st.cache_data
+def filter_options():
+    """Sorted option lists for the sidebar filters, read from the category index."""
+    df = load_data()
+    return {c: df[c].cat.categories.tolist() for c in ["gics_sector", "size_category", "style", "expiry_label", "value_type"]}
+
+@st.cache_data
+def downsample(df, max_pts):
+    """Min/max-decimate each legend_label series to at most max_pts points.
+
+    Each series is split into max_pts // 2 time buckets and only the lowest and
+    highest point of every bucket is kept, so spikes survive the thinning.
+    """
+    parts = []
+    for _, group in df.groupby("legend_label", sort=False):
+        if len(group) <= max_pts:
+            parts.append(group)
+            continue
+        group = group.sort_values("teo")
+        y = group["weighted_value"].to_numpy()
+        edges = np.linspace(0, len(y), max_pts // 2 + 1).astype(int)
+        bucket = np.searchsorted(edges, np.arange(len(y)), side="right") - 1
+        order = np.lexsort((y, bucket))
+        keep = np.unique(np.concatenate([order[edges[:-1]], order[edges[1:] - 1]]))
+        parts.append(group.iloc[keep])
+    return pd.concat(parts, ignore_index=True) if parts else df
+
 df = load_data()
 
 # Value type mapping for display
@@ -46,14 +97,15 @@ value_type_mapping = {
 }
 
 # Sidebar filters
-expiry_label = st.sidebar.multiselect("Expiry Label", sorted(df["expiry_label"].unique()), default=["30"])
-gics_sector = st.sidebar.multiselect("Sector", sorted(df["gics_sector"].unique()), default=["Total"])
-size_category = st.sidebar.multiselect("Size Category", sorted(df["size_category"].unique()), default=["Total"])
-style = st.sidebar.multiselect("Style", sorted(df["style"].unique()), default=["Total"])
+options = filter_options()
+expiry_label = st.sidebar.multiselect("Expiry Label", options["expiry_label"], default=["30"])
+gics_sector = st.sidebar.multiselect("Sector", options["gics_sector"], default=["Total"])
+size_category = st.sidebar.multiselect("Size Category", options["size_category"], default=["Total"])
+style = st.sidebar.multiselect("Style", options["style"], default=["Total"])
 
 # Create display names for value types
-value_type_display_names = [value_type_mapping.get(vt, vt) for vt in sorted(df["value_type"].unique())]
-value_type_original_names = sorted(df["value_type"].unique())
+value_type_original_names = options["value_type"]
+value_type_display_names = [value_type_mapping.get(vt, vt) for vt in value_type_original_names]
 value_type_selection = st.sidebar.multiselect(
     "Value Types", 
     options=value_type_original_names,
@@ -82,148 +134,265 @@ freq_map = {
 }
 resample_freq = st.sidebar.selectbox("Time Aggregation", list(freq_map.keys()))
 freq = freq_map[resample_freq]
+# pandas offset aliases for resampling; the 'M'/'Q'/'Y' codes above stay for pd.Period and store names
+RESAMPLE_RULES = {"D": "D", "W": "W", "M": "ME", "Q": "QE", "Y": "YE"}
 
 show_vix = st.sidebar.checkbox("Include VIX index", value=False)
 
 chart_type = st.sidebar.radio("Chart Type", ["Line", "Bar"])
+max_pts = st.sidebar.slider("Max points per series", min_value=500, max_value=10000, value=2000, step=500)
+
+LABEL_COLS = ["gics_sector", "size_category", "style", "expiry_label", "value_type"]
+PARALLEL_RESAMPLE_ROWS = 2_000_000  # Resample in parallel only above this many filtered rows
+RESAMPLE_CHUNK_GROUPS = 100  # Label combinations per parallel task
+
+def resample_groups(frame, freq):
+    """Mean weighted_value per label combination and resampling period."""
+    return (
+        frame
+        .groupby(LABEL_COLS + [pd.Grouper(key="teo", freq=RESAMPLE_RULES[freq])], observed=True, sort=False)
+        ["weighted_value"].mean()
+        .reset_index()
+    )
 
-# Filter data
-filtered = df[
-    (df["value_type"].isin(value_type_selection)) &
-    (df["expiry_label"].isin(expiry_label)) &
-    (df["gics_sector"].isin(gics_sector)) &
-    (df["size_category"].isin(size_category)) &
-    (df["style"].isin(style)) &
-    (df["teo"].dt.date >= date_range[0]) &
-    (df["teo"].dt.date <= date_range[1])
-]
-
-# Resample data
-resampled = (
-    filtered
-    .groupby(["gics_sector", "size_category", "style", "expiry_label", "value_type", pd.Grouper(key="teo", freq=freq)])
-    ["weighted_value"].mean()
-    .reset_index()
-    .copy()  # Ensure we have a clean DataFrame
+def filter_mask(frame, value_types, expiries, sectors, sizes, styles, start, end):
+    """Rows matching the sidebar selections with start <= teo < end."""
+    return np.logical_and.reduce([
+        frame["value_type"].isin(value_types).to_numpy(),
+        frame["expiry_label"].isin(expiries).to_numpy(),
+        frame["gics_sector"].isin(sectors).to_numpy(),
+        frame["size_category"].isin(sizes).to_numpy(),
+        frame["style"].isin(styles).to_numpy(),
+        (frame["teo"] >= start).to_numpy(),
+        (frame["teo"] < end).to_numpy()
+    ])
+
+@st.cache_data(show_spinner=False)
+def compute_resampled(value_types, expiries, sectors, sizes, styles, start_date, end_date, freq):
+    """Filter the loaded data and resample it; cached on the (hashable) selections."""
+    selections = (value_types, expiries, sectors, sizes, styles)
+    # (timestamps are compared directly; the end date is inclusive)
+    start = pd.Timestamp(start_date)
+    stop = pd.Timestamp(end_date) + pd.Timedelta(days=1)
+
+    # Periods lying wholly inside the selection are taken from the store pre-aggregated by
+    # the production script (the daily store already holds one row per day). A partly
+    # selected edge period must average only the selected days, so it is resampled from
+    # the daily rows below; without a pre-aggregated store everything is.
+    pre_aggregated = []
+    inner_start = inner_stop = start
+    if os.path.exists(store_path(freq)):
+        first, last = pd.Period(start, freq), pd.Period(end_date, freq)
+        inner_start = first.start_time if first.start_time == start else (first + 1).start_time
+        inner_stop = (last + 1).start_time if (last + 1).start_time == stop else last.start_time
+        if inner_start < inner_stop:
+            frame = load_data(store_path(freq))
+            pre_aggregated.append(frame[filter_mask(frame, *selections, inner_start, inner_stop)])
+        else:
+            inner_start = inner_stop = start
+
+    # Filter data (daily rows outside the pre-aggregated periods)
+    mask = filter_mask(df, *selections, start, stop)
+    if inner_start < inner_stop:
+        mask &= ~((df["teo"] >= inner_start) & (df["teo"] < inner_stop)).to_numpy()
+    filtered = df[mask]
+
+    # Resample data (only observed label combinations; the small result is sorted afterwards)
+    if len(filtered) > PARALLEL_RESAMPLE_ROWS:
+        # Split the label combinations into chunks and resample them on all cores
+        group_id = filtered.groupby(LABEL_COLS, observed=True, sort=False).ngroup().to_numpy()
+        chunks = [part for _, part in filtered.groupby(group_id // RESAMPLE_CHUNK_GROUPS, sort=False)]
+        parts = Parallel(n_jobs=-1, backend="loky")(delayed(resample_groups)(part, freq) for part in chunks)
+        resampled = pd.concat(parts, ignore_index=True)
+    else:
+        resampled = resample_groups(filtered, freq)
+
+    if pre_aggregated:
+        columns = LABEL_COLS + ["teo", "weighted_value"]
+        resampled = pd.concat([pre_aggregated[0][columns], resampled[columns]], ignore_index=True)
+        # The two stores carry their own category sets, so re-derive the categoricals
+        for c in LABEL_COLS:
+            resampled[c] = resampled[c].astype(str).astype("category")
+    return resampled.sort_values(LABEL_COLS + ["teo"], ignore_index=True)
+
+resampled = compute_resampled(
+    tuple(sorted(value_type_selection)),
+    tuple(sorted(expiry_label)),
+    tuple(sorted(gics_sector)),
+    tuple(sorted(size_category)),
+    tuple(sorted(style)),
+    date_range[0],
+    date_range[1],
+    freq
 )
 
 # Add a legend_label column for proper legend grouping
-resampled["legend_label"] = (
-    resampled["value_type"].replace(value_type_mapping).astype(str) + ", " +
-    resampled["expiry_label"].astype(str) + ", " +
-    resampled["gics_sector"].astype(str) + ", " +
-    resampled["size_category"].astype(str) + ", " +
-    resampled["style"].astype(str)
+# (label strings are built once per distinct combination, then joined back)
+legend_cols = ["value_type", "expiry_label", "gics_sector", "size_category", "style"]
+combos = resampled[legend_cols].drop_duplicates()
+combos["legend_label"] = (
+    combos["value_type"].astype(str).replace(value_type_mapping) + ", " +
+    combos["expiry_label"].astype(str) + ", " +
+    combos["gics_sector"].astype(str) + ", " +
+    combos["size_category"].astype(str) + ", " +
+    combos["style"].astype(str)
 )
+resampled = resampled.merge(combos, on=legend_cols, how="left")
 
 # Determine number of lines (series) to plot
 num_lines = resampled['legend_label'].nunique()
 if show_vix:
     num_lines += 1
 
-# Base plot arguments
-base_args = {
-    "data_frame": resampled,
-    "x": "teo",
-    "y": "weighted_value",
-    "color": "legend_label",
-    "height": 700,
-    "labels": {"teo": "", "weighted_value": ""}
-}
-
 facet_by = st.sidebar.selectbox("Facet by (optional)", ["None", "Size Category", "GICS Sector","Style"])
 
-if facet_by == "Size Category":
-    base_args["facet_col"] = "size_category"
-elif facet_by == "GICS Sector":
-    base_args["facet_col"] = "gics_sector"
-elif facet_by == "Style":
-    base_args["facet_col"] = "style"
-
-# Create chart based on type
-if chart_type == "Line":
-    plot_args = base_args.copy()
-    plot_args["line_group"] = "style"
-    fig = px.line(**plot_args)
-    for trace in fig.data:
-        trace.connectgaps = False
-else:  # Bar chart
-    plot_args = base_args.copy()
-    fig = px.bar(**plot_args)
-    fig.update_layout(barmode="group")
-fig.update_layout(
-    showlegend=True,
-    title="",
-    legend=dict(
-        x=1.2,
-        y=1,
-        xanchor='left',
-        yanchor='top'
+@st.cache_resource(hash_funcs=FRAME_HASH_FUNCS, max_entries=20)
+def build_figure(resampled, chart_type, facet_by, max_pts, vix_resampled):
+    """Plotly figure for the current selection, reused while the inputs are unchanged."""
+    # Base plot arguments
+    base_args = {
+        "data_frame": resampled,
+        "x": "teo",
+        "y": "weighted_value",
+        "color": "legend_label",
+        "height": 700,
+        "labels": {"teo": "", "weighted_value": ""}
+    }
+
+    if facet_by == "Size Category":
+        base_args["facet_col"] = "size_category"
+    elif facet_by == "GICS Sector":
+        base_args["facet_col"] = "gics_sector"
+    elif facet_by == "Style":
+        base_args["facet_col"] = "style"
+
+    # Create chart based on type
+    if chart_type == "Line":
+        plot_args = base_args.copy()
+        plot_args["data_frame"] = downsample(resampled, max_pts)
+        plot_args["line_group"] = "style"
+        # WebGL traces stay responsive with many series; bars keep the SVG renderer
+        fig = px.line(**plot_args, render_mode="webgl")
+        for trace in fig.data:
+            trace.connectgaps = False
+    else:  # Bar chart
+        plot_args = base_args.copy()
+        fig = px.bar(**plot_args)
+        fig.update_layout(barmode="group")
+    fig.update_layout(
+        showlegend=True,
+        title="",
+        # Keep the user's zoom/pan when a rerun sends a new figure
+        uirevision="keep",
+        legend=dict(
+            x=1.2,
+            y=1,
+            xanchor='left',
+            yanchor='top'
+        )
     )
-)
 
-if show_vix:
-    vix = load_vix()
-    if not vix.empty:
-        vix['Date'] = pd.to_datetime(vix['Date'])
-        resampled_dates = pd.to_datetime(resampled['teo'])
-        vix_filtered = vix[(vix['Date'] >= resampled_dates.min()) & (vix['Date'] <= resampled_dates.max())]
-        if not vix_filtered.empty:
-            vix_filtered = vix_filtered.set_index('Date')
-            vix_resampled = vix_filtered.resample(freq).mean().reset_index()
+    if vix_resampled is not None:
+        if not vix_resampled.empty:
             if facet_by != "None":
-                fig.add_scatter(
-                    x=vix_resampled["Date"],
-                    y=vix_resampled["VIX"],
-                    name="VIX",
-                    yaxis="y2",
-                    line=dict(color='red', width=2),
+                fig.add_trace(
+                    go.Scattergl(
+                        x=vix_resampled["Date"],
+                        y=vix_resampled["VIX"].to_numpy(dtype=float),
+                        name="VIX",
+                        yaxis="y2",
+                        line=dict(color='red', width=2)
+                    ),
                     row=1,
                     col=1
                 )
             else:
-                fig.add_scatter(
-                    x=vix_resampled["Date"],
-                    y=vix_resampled["VIX"],
-                    name="VIX",
-                    yaxis="y2",
-                    line=dict(color='red', width=2)
+                fig.add_trace(
+                    go.Scattergl(
+                        x=vix_resampled["Date"],
+                        y=vix_resampled["VIX"].to_numpy(dtype=float),
+                        name="VIX",
+                        yaxis="y2",
+                        line=dict(color='red', width=2)
+                    )
                 )
-    fig.update_layout(
-        yaxis2=dict(
-            title="VIX",
-            overlaying='y',
-            side='right',
-            showgrid=False
-        )
+        fig.update_layout(
+            yaxis2=dict(
+                title="VIX",
+                overlaying='y',
+                side='right',
+                showgrid=False
+            )
         
-    )
+        )
 
-# Update facet titles
-for anno in fig.layout.annotations:
-    anno.text = anno.text.replace("gics_sector=", "Sector=")
+    # Update facet titles
+    for anno in fig.layout.annotations:
+        anno.text = anno.text.replace("gics_sector=", "Sector=")
 
+    return fig
+
+vix_resampled = None
+if show_vix:
+    # Fetch over the selected dates rather than the resampled teo span: the scalars need no
+    # pass over the frame, and period labels (e.g. month ends) would clip the first period
+    if resampled.empty:
+        vix_resampled = pd.DataFrame(columns=["Date", "VIX"])
+    else:
+        vix_resampled = load_vix(pd.Timestamp(date_range[0]), pd.Timestamp(date_range[1]), freq)
+fig = build_figure(resampled, chart_type, facet_by, max_pts, vix_resampled)
+# st.plotly_chart serializes with validate=False and plotly picks orjson when it is installed
 st.plotly_chart(fig, use_container_width=True)
 
 # Show data table
 st.subheader("Data Table")
-resampled['teo'] = resampled['teo'].dt.date  # Strip time
-cols = ['teo'] + [col for col in resampled.columns if col != 'teo']
-st.dataframe(resampled[cols])
+# teo stays datetime64; the column config only formats it (no reordered copy, no date objects)
+st.dataframe(
+    resampled,
+    column_order=['teo'] + [col for col in resampled.columns if col != 'teo'],
+    column_config={'teo': st.column_config.DatetimeColumn(format="YYYY-MM-DD")},
+    hide_index=True
+)
 
-@st.cache_data
+@st.cache_data(hash_funcs=FRAME_HASH_FUNCS)
 def convert_to_excel(df):
     output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+    # xlsxwriter is much faster than openpyxl (constant_memory can't be used: pandas writes column-wise)
+    with pd.ExcelWriter(output, engine='xlsxwriter', datetime_format='YYYY-MM-DD') as writer:
         df.to_excel(writer, index=False, sheet_name='IV Data')
     return output.getvalue()
 
+@st.cache_data(hash_funcs=FRAME_HASH_FUNCS)
+def convert_to_parquet(df):
+    output = io.BytesIO()
+    df.to_parquet(output, engine='pyarrow', compression='snappy', index=False)
+    return output.getvalue()
+
+@st.cache_data(hash_funcs=FRAME_HASH_FUNCS)
+def convert_to_csv(df):
+    return df.to_csv(index=False).encode('utf-8')
+
+
+# Columnar formats are the default; Excel is much slower to produce for large selections
+download_format = st.radio("Download format", ["Parquet", "CSV", "Excel"], horizontal=True)
+if download_format == "Parquet":
+    download_data = convert_to_parquet(resampled)
+    file_name = "iv_dashboard_data.parquet"
+    mime = "application/vnd.apache.parquet"
+elif download_format == "CSV":
+    download_data = convert_to_csv(resampled)
+    file_name = "iv_dashboard_data.csv"
+    mime = "text/csv"
+else:
+    download_data = convert_to_excel(resampled)
+    file_name = "iv_dashboard_data.xlsx"
+    mime = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
 
 st.download_button(
-    label="📥 Download Excel",
-    data=convert_to_excel(resampled),
-    file_name="iv_dashboard_data.xlsx",
-    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    label=f"📥 Download {download_format}",
+    data=download_data,
+    file_name=file_name,
+    mime=mime
 )
 
 with st.expander("ℹ️ Click to view data processing notes"):
@@ -179,6 +179,18 @@ fs_industry_to_gic_name = {
     if gic_code_to_gic_name.get(gic_code) is not None
 }
 
+# Sorted FactSet codes with their GICS codes (-1 where unmapped) for vectorized lookups
+_items = sorted(fs_industry_to_gic_code.items())
+_FS = np.array([fs_code for fs_code, _ in _items], dtype=np.int32)
+_GICS = np.array([-1 if np.isnan(gic_code) else gic_code for _, gic_code in _items], dtype=np.int8)
+
+
+def map_fs_to_gics(fs_codes):
+    """Map an array of FactSet industry codes to int8 GICS codes, -1 where unmapped."""
+    fs_codes = np.asarray(fs_codes)
+    pos = np.searchsorted(_FS, fs_codes).clip(max=len(_FS) - 1)
+    return np.where(_FS[pos] == fs_codes, _GICS[pos], -1).astype(np.int8)
+
 gic_name_to_spdr_ticker = {
     gic_code_to_gic_name[gic_code]: ticker
     for ticker, gic_code in spdr_to_gic_code.items()
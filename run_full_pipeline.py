@@ -5,14 +5,14 @@ Incremental IV (Implied Volatility) Data Pipeline Orchestrator
 This script runs the complete pipeline in incremental mode:
 1. Download new ZIP files (1_download_zips.py) - ONLY missing dates
 2. Process new ZIPs to Zarr format and APPEND to existing combined zarr (2_zips_to_zarrs_combined.py) 
-3. Download daily ticker dataset from GCS (gsutil command)
+3. Download daily ticker dataset from GCS (gcloud storage, or gsutil if gcloud is missing)
 4. Produce IV dataset (3_produce_iv_dataset_full.py)
 5. Upload to Google Cloud Platform (4_upload_to_gc.py)
 
 The pipeline is optimized for efficiency:
 - Only downloads files for dates not already in the zips directory
 - Appends new data to existing combined zarr store
-- Downloads latest daily ticker dataset for IV processing
+- Downloads latest daily ticker dataset for IV processing (concurrently with step 2)
 - Produces updated IV dataset
 - Efficiently uploads updated zarr to GCP
 
@@ -25,17 +25,35 @@ Options:
     --verbose    Enable detailed logging
 """
 
+import asyncio
 import subprocess
 import sys
 import logging
 import argparse
+import json
 import yaml
 from pathlib import Path
 import os
-from datetime import datetime
+from datetime import date, datetime
 import re
-import glob
-import pandas as pd
+import shutil
+import stat
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+OUTPUT_TAIL_LINES = 200  # Lines of child output kept for error reports
+
+# Date suffix of downloaded ZIP names, e.g. surface_curve_hist_2024-01-31.zip
+_ZIP_DATE_RE = re.compile(r'_(\d{4}-\d{2}-\d{2})\.zip$')
+
+# Date suffixes accepted by extract_date_from_filename, tried in order
+_DATE_PATTERNS = tuple(re.compile(pattern) for pattern in (
+    r'(\d{4}-\d{2}-\d{2})$',  # YYYY-MM-DD at end
+    r'_(\d{4}-\d{2}-\d{2})$',  # _YYYY-MM-DD at end
+    r'(\d{4}_\d{2}_\d{2})$',  # YYYY_MM_DD at end
+    r'_(\d{4}_\d{2}_\d{2})$',  # _YYYY_MM_DD at end
+))
 
 def setup_logging(verbose=False):
     """Set up logging configuration."""
@@ -47,8 +65,9 @@ def setup_logging(verbose=False):
     )
     return logging.getLogger(__name__)
 
+@lru_cache(maxsize=1)
 def load_config():
-    """Load configuration from config.yaml."""
+    """Load configuration from config.yaml (parsed once per process)."""
     # Get the directory where this script is located
     script_dir = Path(__file__).parent
     config_path = script_dir / 'config.yaml'
@@ -61,94 +80,192 @@ def load_config():
     
     return config
 
+def get_pipeline_paths(config):
+    """ZIP directory and combined Zarr store from config.yaml, relative paths taken from the script directory."""
+    script_dir = Path(__file__).parent
+    options_paths = config['paths']['options']
+    zip_dir = script_dir / options_paths['zip_input']
+    zarr_path = script_dir / options_paths['zarr_output'] / 'surface_curve_history_combined_data_vars.zarr'
+    return str(zip_dir), str(zarr_path)
+
+@lru_cache(maxsize=4096)
 def extract_date_from_filename(filename):
     """Extract date from filename using various patterns."""
     base_name = filename.replace('.zip', '')
     
-    patterns = [
-        r'(\d{4}-\d{2}-\d{2})$',  # YYYY-MM-DD at end
-        r'_(\d{4}-\d{2}-\d{2})$',  # _YYYY-MM-DD at end
-        r'(\d{4}_\d{2}_\d{2})$',  # YYYY_MM_DD at end
-        r'_(\d{4}_\d{2}_\d{2})$',  # _YYYY_MM_DD at end
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, base_name)
+    for pattern in _DATE_PATTERNS:
+        match = pattern.search(base_name)
         if match:
+            # The pattern fixes the layout, so the C ISO parser can replace strptime
             date_str = match.group(1).replace('_', '-')
             try:
-                return datetime.strptime(date_str, '%Y-%m-%d')
+                return datetime.fromisoformat(date_str)
             except ValueError:
                 continue
     
     return None
 
-def get_latest_zip_date(zip_dir):
-    """Get the latest date from the ZIP filenames."""
-    zip_path = Path(zip_dir)
-    if not zip_path.exists():
-        return None
+def _iter_zips(zip_dir):
+    """Yield the DirEntry of each ZIP file in zip_dir (a suffix test on the cached entry, no glob)."""
+    with os.scandir(zip_dir) as entries:
+        yield from (
+            entry for entry in entries
+            if entry.name.endswith('.zip') and entry.is_file(follow_symlinks=False)
+        )
+
+def scan_zips(zip_dir):
+    """Count the ZIP files in zip_dir and find the latest filename date in one directory pass.
 
-    zip_files = list(zip_path.glob('*.zip'))
-    dates = []
+    One stat of the directory keys an in-process cache: adding or removing files
+    changes its mtime, so an unchanged directory is not walked again.
+    """
+    try:
+        zip_dir_stat = os.stat(zip_dir)
+    except OSError:
+        return 0, None
+    if not stat.S_ISDIR(zip_dir_stat.st_mode):
+        return 0, None
+    return _scan_zips_cached(str(zip_dir), zip_dir_stat.st_mtime_ns)
 
-    for zip_file in zip_files:
-        match = re.search(r'_(\d{4}-\d{2}-\d{2})$', zip_file.stem)
+@lru_cache(maxsize=8)
+def _scan_zips_cached(zip_dir, mtime_ns):
+    """scan_zips for one version (mtime) of the directory."""
+    count = 0
+    latest = None
+    for entry in _iter_zips(zip_dir):
+        count += 1
+        match = _ZIP_DATE_RE.search(entry.name)
         if match:
             try:
-                date = datetime.strptime(match.group(1), '%Y-%m-%d').date()
-                dates.append(date)
+                zip_date = date.fromisoformat(match.group(1))
             except ValueError:
                 continue
+            if latest is None or zip_date > latest:
+                latest = zip_date
 
-    return max(dates) if dates else None
+    return count, latest
+
+def get_latest_zip_date(zip_dir):
+    """Get the latest date from the ZIP filenames."""
+    return scan_zips(zip_dir)[1]
 
 
 def get_latest_zarr_date(zarr_path):
-    """Get the latest date from a Zarr store."""
+    """Get the latest date from a Zarr store.
+
+    The combined store is written sorted by date, so only the last element of
+    its time array is read instead of the whole coordinate.
+    """
     try:
-        import xarray as xr
+        # Heavy imports stay local so runs that hit the scan cache never load them
+        import pandas as pd
+        import zarr
+        from xarray.coding.times import decode_cf_datetime
         
         zarr_path = Path(zarr_path)
         if not zarr_path.exists():
             return None
         
-        ds = xr.open_zarr(str(zarr_path))
+        try:
+            root = zarr.open_consolidated(str(zarr_path), mode='r')
+        except KeyError:
+            root = zarr.open(str(zarr_path), mode='r')
         
-        # Try different possible time dimension names
-        time_dims = []
-        for dim in ds.dims:
-            if any(time_name in dim.lower() for time_name in ['time', 'date', 'teo']):
-                time_dims.append(dim)
-        
-        if not time_dims:
+        # The pipeline's writers record the time variable in the _time_dim attribute;
+        # for other stores prefer teo, otherwise the first array whose name looks like time
+        time_name = root.attrs.get('_time_dim')
+        if not time_name or time_name not in root:
+            if 'teo' in root:
+                time_name = 'teo'
+            else:
+                time_name = next(
+                    (name for name in root.array_keys()
+                     if any(time_part in name.lower() for time_part in ['time', 'date', 'teo'])),
+                    None
+                )
+        if time_name is None:
             return None
         
-        # Use the first time dimension found
-        time_dim = time_dims[0]
-        time_data = ds[time_dim].values
-        
-        if len(time_data) == 0:
+        time_array = root[time_name]
+        if time_array.shape[0] == 0:
             return None
         
-        # Convert to datetime and get the latest
-        if hasattr(time_data, 'max'):
-            latest_timestamp = time_data.max()
-        else:
-            latest_timestamp = max(time_data)
-        
-        # Convert numpy datetime64 to Python datetime if needed
-        if hasattr(latest_timestamp, 'astype'):
-            latest_timestamp = pd.to_datetime(latest_timestamp)
+        # Decode CF-encoded integers (as written by xarray or the pipeline scripts)
+        last = time_array[-1:]
+        if 'units' in time_array.attrs:
+            last = decode_cf_datetime(last, time_array.attrs['units'], time_array.attrs.get('calendar'))
         
-        return latest_timestamp
+        return pd.to_datetime(last[0]).to_pydatetime()
         
     except Exception as e:
         logging.getLogger(__name__).warning(f"Could not read Zarr date from {zarr_path}: {e}")
         return None
 
-def run_script(script_name, logger, dry_run=False, cwd=None, extra_args=None):
-    """Run a Python script and return success status."""
+def get_zarr_scan_cache_path(zarr_path):
+    """Path of the JSON sidecar caching the store's latest date."""
+    return os.path.splitext(zarr_path)[0] + '_last_scan.json'
+
+def scan_zarr(zarr_path):
+    """Return whether the Zarr store exists and its latest date (None if missing or unreadable).
+
+    The date is cached keyed on the mtime of the store's consolidated metadata,
+    which every write rewrites, so an unchanged store is not opened.
+    """
+    if not Path(zarr_path).exists():
+        return False, None
+    
+    try:
+        mtime_ns = os.stat(os.path.join(zarr_path, '.zmetadata')).st_mtime_ns
+    except OSError:
+        # Not consolidated, so there is nothing cheap to key a cache on
+        return True, get_latest_zarr_date(zarr_path)
+    
+    return True, get_cached_zarr_date(str(zarr_path), mtime_ns)
+
+@lru_cache(maxsize=8)
+def get_cached_zarr_date(zarr_path, mtime_ns):
+    """Latest date of one version of a store: memoized in-process, backed by a sidecar across runs."""
+    cache_path = get_zarr_scan_cache_path(zarr_path)
+    try:
+        with open(cache_path, 'r') as f:
+            cache = json.load(f)
+        if cache['mtime_ns'] == mtime_ns:
+            return datetime.fromisoformat(cache['date']) if cache['date'] else None
+    except (OSError, ValueError, KeyError):
+        pass
+    
+    latest_zarr_date = get_latest_zarr_date(zarr_path)
+    try:
+        with open(cache_path, 'w') as f:
+            json.dump({'mtime_ns': mtime_ns, 'date': latest_zarr_date.isoformat() if latest_zarr_date is not None else None}, f)
+    except OSError as e:
+        logging.getLogger(__name__).warning(f"Could not write Zarr scan cache {cache_path}: {e}")
+    
+    return latest_zarr_date
+
+async def stream_output(proc, logger):
+    """Log a child's merged stdout/stderr at DEBUG as it arrives; return its exit code and last lines.
+
+    Only the last OUTPUT_TAIL_LINES lines are kept, so long progress output is
+    never buffered whole. Carriage returns (progress bars) also end a line.
+    """
+    tail = deque(maxlen=OUTPUT_TAIL_LINES)
+    pending = b''
+    while chunk := await proc.stdout.read(65536):
+        *lines, pending = re.split(rb'[\r\n]', pending + chunk)
+        for line in lines:
+            if line:
+                line = line.decode(errors='replace')
+                logger.debug(line)
+                tail.append(line)
+    if pending:
+        line = pending.decode(errors='replace')
+        logger.debug(line)
+        tail.append(line)
+    return await proc.wait(), '\n'.join(tail)
+
+async def run_script_async(script_name, logger, dry_run=False, cwd=None, extra_args=None):
+    """Run a Python script as a subprocess without blocking the event loop; return success status."""
     # Get the directory where this script is located
     script_dir = Path(__file__).parent
     script_path = script_dir / script_name
@@ -172,27 +289,36 @@ def run_script(script_name, logger, dry_run=False, cwd=None, extra_args=None):
             cmd.extend(extra_args)
         
         # Run the script in the same Python environment
-        result = subprocess.run(cmd, capture_output=True, text=True, cwd=working_dir)
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=working_dir
+        )
+        returncode, tail = await stream_output(proc, logger)
         
-        if result.returncode == 0:
+        if returncode == 0:
             logger.info(f"✓ {script_name} completed successfully")
-            if result.stdout:
-                logger.debug(f"STDOUT: {result.stdout}")
             return True
         else:
-            logger.error(f"✗ {script_name} failed with return code {result.returncode}")
-            if result.stderr:
-                logger.error(f"STDERR: {result.stderr}")
-            if result.stdout:
-                logger.error(f"STDOUT: {result.stdout}")
+            logger.error(f"✗ {script_name} failed with return code {returncode}")
+            if tail:
+                logger.error(f"OUTPUT (last {OUTPUT_TAIL_LINES} lines):\n{tail}")
             return False
             
     except Exception as e:
         logger.error(f"✗ Error running {script_name}: {str(e)}")
         return False
 
+def run_script(script_name, logger, dry_run=False, cwd=None, extra_args=None):
+    """Run a Python script and return success status."""
+    return asyncio.run(run_script_async(script_name, logger, dry_run, cwd, extra_args))
+
+async def run_steps_concurrently(steps):
+    """Await independent step coroutines together; return {step name: success}."""
+    results = await asyncio.gather(*steps.values())
+    return dict(zip(steps, results))
+
 def check_pipeline_status(config, logger):
     """Check the current status of the pipeline and determine what needs to be run."""
+    zip_dir, zarr_path = get_pipeline_paths(config)
     status = {
         'needs_download': False,
         'needs_processing': False,
@@ -204,19 +330,18 @@ def check_pipeline_status(config, logger):
         'zarr_exists': False
     }
     
-    # Check ZIP files
-    zip_dir = r"C:\Users\gigan\OneDrive\Desktop\BlueWaterMacro\data\sr_options\data\surfacecurvehist\zips"
-    latest_zip_date = get_latest_zip_date(zip_dir)
-    zip_files = list(Path(zip_dir).glob('*.zip')) if Path(zip_dir).exists() else []
+    # Scan the ZIP directory and the Zarr store side by side; both are storage-latency bound
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        zip_scan = executor.submit(scan_zips, zip_dir)
+        zarr_scan = executor.submit(scan_zarr, zarr_path)
+        zip_count, latest_zip_date = zip_scan.result()
+        zarr_exists, latest_zarr_date = zarr_scan.result()
     
+    # Check ZIP files
     status['latest_zip_date'] = latest_zip_date
-    status['zip_count'] = len(list(Path(zip_dir).glob('*.zip')))
+    status['zip_count'] = zip_count
     
     # Check Zarr store
-    zarr_path = r"C:\Users\gigan\OneDrive\Desktop\BlueWaterMacro\data\sr_options\data\surfacecurvehist\surface_curve_history_combined.zarr"
-    zarr_exists = Path(zarr_path).exists()
-    latest_zarr_date = get_latest_zarr_date(zarr_path) if zarr_exists else None
-    
     status['zarr_exists'] = zarr_exists
     status['latest_zarr_date'] = latest_zarr_date
     
@@ -231,7 +356,7 @@ def check_pipeline_status(config, logger):
     if not zarr_exists:
         status['needs_processing'] = True
         logger.info("Processing needed: No Zarr store exists")
-    elif zip_files:
+    elif zip_count:
         status['needs_processing'] = True
         logger.info("Processing needed: Have ZIP files to process")
     else:
@@ -266,35 +391,41 @@ def check_daily_ticker_dataset():
     except Exception as e:
         return False, f"Error checking dataset age: {e}"
 
-def run_gsutil_command(cmd, logger, dry_run=False):
-    """Run a gsutil command and return success status."""
-    logger.info(f"{'[DRY RUN] Would run' if dry_run else 'Running'}: {cmd}")
+def get_gcs_copy_command(source, destination):
+    """Argument list copying a GCS path recursively: gcloud storage if installed, else gsutil -m."""
+    gcloud = shutil.which('gcloud')
+    if gcloud:
+        return [gcloud, 'storage', 'cp', '--recursive', source, destination]
+    return [shutil.which('gsutil') or 'gsutil', '-m', 'cp', '-r', source, destination]
+
+async def run_gsutil_command_async(cmd, logger, dry_run=False):
+    """Run a GCS command (argument list, no shell) without blocking the event loop; return success status."""
+    logger.info(f"{'[DRY RUN] Would run' if dry_run else 'Running'}: {' '.join(cmd)}")
     
     if dry_run:
         return True
     
     try:
-        result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
+        proc = await asyncio.create_subprocess_exec(*cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        returncode, tail = await stream_output(proc, logger)
         
-        if result.returncode == 0:
-            logger.info(f"✓ gsutil command completed successfully")
-            if result.stdout:
-                logger.debug(f"STDOUT: {result.stdout}")
-            if result.stderr:
-                logger.debug(f"STDERR: {result.stderr}")
+        if returncode == 0:
+            logger.info(f"✓ GCS command completed successfully")
             return True
         else:
-            logger.error(f"✗ gsutil command failed with return code {result.returncode}")
-            if result.stderr:
-                logger.error(f"STDERR: {result.stderr}")
-            if result.stdout:
-                logger.error(f"STDOUT: {result.stdout}")
+            logger.error(f"✗ GCS command failed with return code {returncode}")
+            if tail:
+                logger.error(f"OUTPUT (last {OUTPUT_TAIL_LINES} lines):\n{tail}")
             return False
             
     except Exception as e:
-        logger.error(f"✗ Error running gsutil command: {str(e)}")
+        logger.error(f"✗ Error running GCS command: {str(e)}")
         return False
 
+def run_gsutil_command(cmd, logger, dry_run=False):
+    """Run a GCS command (argument list) and return success status."""
+    return asyncio.run(run_gsutil_command_async(cmd, logger, dry_run))
+
 def main():
     """Main pipeline orchestrator function."""
     parser = argparse.ArgumentParser(description='Run incremental IV data pipeline')
@@ -354,26 +485,28 @@ def main():
         else:
             logger.info("\n⏭️  STEP 1: Skipping download - no new files expected")
         
-        # Re-check status after download to see if we got new files
+        # Re-check the ZIP directory after download to see if we got new files
+        # (the Zarr store is untouched by step 1, so it is not re-read)
         if not args.dry_run and status['needs_download']:
-            logger.info("🔄 Re-checking status after download...")
-            new_status = check_pipeline_status(config, logger)
-            if new_status['latest_zip_date'] != status['latest_zip_date']:
-                logger.info(f"✓ New files downloaded! Latest ZIP date changed from {status['latest_zip_date']} to {new_status['latest_zip_date']}")
+            logger.info("🔄 Re-checking ZIP files after download...")
+            zip_dir, _ = get_pipeline_paths(config)
+            _, new_latest_zip_date = scan_zips(zip_dir)
+            if new_latest_zip_date != status['latest_zip_date']:
+                logger.info(f"✓ New files downloaded! Latest ZIP date changed from {status['latest_zip_date']} to {new_latest_zip_date}")
                 status['needs_processing'] = True
             else:
                 logger.info("ℹ️  No new files were downloaded")
                 if not args.force:
                     status['needs_processing'] = False
         
+        # Steps 2 and 3 are independent (local ZIP processing vs. a GCS download),
+        # so whichever of them is needed runs concurrently; step 4 waits for both
+        concurrent_steps = {}
+        
         # Step 2: Process ZIP files to Zarr (append to existing)
         if status['needs_processing']:
             logger.info("\n⚙️  STEP 2: Processing ZIP files to Zarr format (appending to existing)...")
-            success = run_script('2_zips_to_zarrs_combined.py', logger, args.dry_run)
-            if not success:
-                logger.error("❌ Processing step failed - stopping pipeline")
-                return 1
-            steps_run += 1
+            concurrent_steps['processing'] = run_script_async('2_zips_to_zarrs_combined.py', logger, args.dry_run)
         else:
             logger.info("\n⏭️  STEP 2: Skipping processing - no new data to process")
         
@@ -389,16 +522,26 @@ def main():
                 logger.info("✓ Daily ticker dataset is recent - skipping download")
             else:
                 # Download the dataset
-                gsutil_cmd = "gsutil -m cp -r gs://rm_api_data/ds_daily_ticker.zarr ."
-                success = run_gsutil_command(gsutil_cmd, logger, args.dry_run)
-                if not success:
-                    logger.error("❌ Daily ticker dataset download failed")
-                    overall_success = False
-                else:
-                    steps_run += 1
+                gcs_cmd = get_gcs_copy_command('gs://rm_api_data/ds_daily_ticker.zarr', '.')
+                concurrent_steps['daily_ticker'] = run_gsutil_command_async(gcs_cmd, logger, args.dry_run)
         else:
             logger.info("\n⏭️  STEP 3: Skipping daily ticker dataset download - no IV processing needed")
         
+        results = asyncio.run(run_steps_concurrently(concurrent_steps)) if concurrent_steps else {}
+        
+        if 'daily_ticker' in results:
+            if not results['daily_ticker']:
+                logger.error("❌ Daily ticker dataset download failed")
+                overall_success = False
+            else:
+                steps_run += 1
+        
+        if 'processing' in results:
+            if not results['processing']:
+                logger.error("❌ Processing step failed - stopping pipeline")
+                return 1
+            steps_run += 1
+        
         # Step 4: Produce IV dataset
         if status['needs_iv_dataset']:
             logger.info("\n📊 STEP 4: Producing IV dataset...")
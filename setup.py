@@ -5,8 +5,10 @@ Setup script for SpiderRock Options Data Pipeline
 This script helps users configure the repository for their environment.
 """
 
+import importlib.util
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import yaml
 
@@ -61,6 +63,17 @@ def validate_config():
     except Exception as e:
         print(f"Error reading config.yaml: {e}")
 
+def _is_installed(package):
+    """Return (package, True) if its module can be found, else (package, False).
+
+    Only the import machinery's finders run; the module itself is not executed,
+    which also makes the probes safe to run from several threads at once.
+    """
+    try:
+        return package, importlib.util.find_spec(package.replace('-', '_')) is not None
+    except (ImportError, ValueError):
+        return package, False
+
 def check_dependencies():
     """Check if required packages are installed."""
     required_packages = [
@@ -78,13 +91,10 @@ def check_dependencies():
         'gcsfs'
     ]
     
-    missing_packages = []
-    
-    for package in required_packages:
-        try:
-            __import__(package.replace('-', '_'))
-        except ImportError:
-            missing_packages.append(package)
+    # Probe the packages in parallel; the finders' path lookups are file I/O that releases the GIL
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(_is_installed, required_packages))
+    missing_packages = [package for package, ok in results if not ok]
     
     if missing_packages:
         print("Missing packages:")
@@ -0,0 +1,72 @@
+import numpy as np
+import xarray as xr
+import zarr
+from numcodecs import Blosc, VLenUTF8
+
+# Flat zarr column writer shared by the zip-to-zarr and IV dataset scripts. Each column is
+# one appendable array along the flat 'index' dimension, in the layout xr.open_zarr reads.
+
+CHUNK_ROWS = 1_000_000  # Rows per zarr chunk along the flat index dimension
+COMPRESSOR = Blosc(cname='zstd', clevel=3, shuffle=Blosc.SHUFFLE)
+
+def encode_column(values, zarray):
+    """Encode column values for an existing zarr array (CF-encoded datetimes, storage dtype)."""
+    if np.issubdtype(values.dtype, np.datetime64):
+        values, _, _ = xr.coding.times.encode_cf_datetime(
+            values, zarray.attrs['units'], zarray.attrs.get('calendar'), dtype=zarray.dtype
+        )
+    elif zarray.dtype.kind in 'iu' and values.dtype.kind == 'f' and np.isnan(values).any():
+        # Integer arrays have no fill value, so a null would be cast to an arbitrary integer
+        raise ValueError(f"Column {zarray.name} has missing values but is stored as {zarray.dtype}")
+    return values.astype(zarray.dtype, copy=False)
+
+def create_column_array(root, name, values, dtypes=None):
+    """Create an empty, appendable zarr array for a column in the layout xarray reads.
+
+    ``dtypes`` optionally maps numeric column names to their on-disk dtype.
+    """
+    if np.issubdtype(values.dtype, np.datetime64):
+        zarray = root.create_dataset(name, shape=(0,), chunks=(CHUNK_ROWS,), dtype='int64',
+                                     compressor=COMPRESSOR, fill_value=None)
+        zarray.attrs.update({'units': 'nanoseconds since 1970-01-01', 'calendar': 'proleptic_gregorian'})
+    elif values.dtype == object:
+        zarray = root.create_dataset(name, shape=(0,), chunks=(CHUNK_ROWS,), dtype=object,
+                                     object_codec=VLenUTF8(), compressor=COMPRESSOR, fill_value=None)
+    else:
+        dtype = np.dtype((dtypes or {}).get(name, values.dtype))
+        fill_value = np.nan if dtype.kind == 'f' else None
+        zarray = root.create_dataset(name, shape=(0,), chunks=(CHUNK_ROWS,), dtype=dtype,
+                                     compressor=COMPRESSOR, fill_value=fill_value)
+    zarray.attrs['_ARRAY_DIMENSIONS'] = ['index']
+    return zarray
+
+def write_columns_to_zarr(columns, zarr_path, mode, dtypes=None):
+    """Write or append flat columns straight to a zarr group, bypassing xarray.
+
+    ``mode='w'`` creates the store, ``mode='a'`` appends to the existing arrays.
+    Either every column is appended or none is, and the consolidated metadata is
+    only refreshed after a complete write. The resulting store opens with
+    ``xr.open_zarr`` like one written by xarray.
+    """
+    root = zarr.open_group(zarr_path, mode=mode)
+    original_shapes = {name: root[name].shape for name in columns if name in root}
+    arrays = {}
+    try:
+        for name, values in columns.items():
+            arrays[name] = root[name] if name in root else create_column_array(root, name, values, dtypes)
+
+        # Encode every column before appending any, so a bad column cannot leave the store misaligned
+        encoded = {name: encode_column(values, arrays[name]) for name, values in columns.items()}
+        for name, values in encoded.items():
+            arrays[name].append(values)
+    except Exception:
+        # All or nothing: shrink existing arrays back and drop the ones made by this write
+        for name in arrays:
+            if name in original_shapes:
+                arrays[name].resize(original_shapes[name])
+            else:
+                del root[name]
+        raise
+    root.attrs['columns'] = [name for name in columns if name != 'index']
+    root.attrs['_time_dim'] = 'teo'  # Lets readers find the time variable without scanning names
+    zarr.consolidate_metadata(zarr_path)